@@ -261,7 +261,7 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 	static Message<128> msg;
 	static struct layer_state lr_prev;
 	static struct global_state gs_prev;
-	static uint8_t _sysex[32];
+	static uint8_t _sysex[64];
 
 	uint8_t * s;
 	uint8_t cmd;
@@ -288,8 +288,10 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 	c += 4;
 
 	if (cmd == MIDIBOX_CMD_WRITE_REQ && layer == MIDIBOX_LAYER_ID_GLOBAL) {
-		if (reqlen != len || offset + reqlen > sizeof(gs.r))
-			return;
+		if (reqlen != len || offset + reqlen > sizeof(gs.r)) {
+			rescmd = MIDIBOX_CMD_WRITE_NAK;
+			goto response;
+		}
 
 		gs_prev = gs;
 
@@ -313,6 +315,9 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 		if (changes.gs_tempo)
 			midi_change_tempo(gs.tempo);
 
+		memcpy(s, ((uint8_t*)(&gs.r)) + offset, reqlen);
+		reslen = reqlen;
+		rescmd = MIDIBOX_CMD_WRITE_ACK;
 	} else if (cmd == MIDIBOX_CMD_READ_REQ && layer == MIDIBOX_LAYER_ID_GLOBAL) {
 		if (offset + reqlen > sizeof(gs.r))
 			return;
@@ -323,8 +328,10 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 	} else if (cmd == MIDIBOX_CMD_WRITE_REQ && layer < LAYERS) {
 		struct layer_state & lr = ls[layer];
 
-		if (reqlen != len || offset + reqlen > sizeof(lr.r))
-			return;
+		if (reqlen != len || offset + reqlen > sizeof(lr.r)) {
+			rescmd = MIDIBOX_CMD_WRITE_NAK;
+			goto response;
+		}
 
 		lr_prev = ls[layer];
 
@@ -360,6 +367,10 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 		}
 #endif
 		midi_update_layer(lr, lr_prev, changes);
+
+		memcpy(s, ((uint8_t*)(&lr.r)) + offset, reqlen);
+		reslen = reqlen;
+		rescmd = MIDIBOX_CMD_WRITE_ACK;
 	} else if (cmd == MIDIBOX_CMD_READ_REQ && layer < LAYERS) {
 		struct layer_state & lr = ls[layer];
 
@@ -371,7 +382,9 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 		rescmd = MIDIBOX_CMD_READ_RES;
 	}
 
-	if (reslen) {
+response:
+	/* WRITE_NAK echoes the request header without data */
+	if (reslen || rescmd == MIDIBOX_CMD_WRITE_NAK) {
 		uint8_t *m = &(msg.sysexArray[1]);
 
 		memcpy(m + 4, s, reslen);
@@ -380,7 +393,7 @@ void midi_handle_controller_cmd(int origin, const uint8_t *c, uint16_t len)
 		m[0] = c[-4]; /* TODO: set correct destination */
 		m[1] = ((rescmd & 0x07) << 4) | (layer & 0x0F);
 		m[2] = offset;
-		m[3] = reslen;
+		m[3] = rescmd == MIDIBOX_CMD_WRITE_NAK ? reqlen : reslen;
 
 		reslen += 4;
 
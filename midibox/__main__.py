@@ -6,11 +6,11 @@ import argparse
 from . import backends
 from .mido import MidoMidibox
 from .osc.client_handler import MidiboxOSCClientHandler
-from .osc.server import TCPOSCServer, ZCPublisher
+from .osc.server import TCPOSCServer, UDPOSCTransport, ZCPublisher
 
 from .midiplayer import Midiplayer, MidiplayerOSCClientHandler
 from .controller import BaseMidibox
-from .recorder import Recorder
+from .recorder import Recorder, RecorderOSCClientHandler
 
 
 def parse_args() -> argparse.Namespace:
@@ -24,6 +24,10 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("-c", "--config", help="Configuration YAML", default=None)
 
     parser.add_argument("--osc-server-port", help="Specify OSC server port", metavar='int', type=int, default=4302)
+    parser.add_argument("--osc-coalesce-window", help="Coalesce OSC state updates to clients within window (seconds)", metavar='float', type=float, default=0.005)
+    parser.add_argument("--osc-udp", help="Send / receive MIDI echo and player position by UDP", action='store_true')
+    parser.add_argument("--osc-udp-port", help="Specify OSC server UDP port", metavar='int', type=int, default=4302)
+    parser.add_argument("--osc-multicast", help="Use multicast group[:port] for the UDP streams, port defaults to the UDP port (server) or the server port (client)", metavar='addr', default=None)
     parser.add_argument("--disable-sandbox", help="Disable sandbox for QtWebEngine", action='store_true')
     return parser.parse_args()
 
@@ -36,6 +40,8 @@ def create_midibox_instance(args: argparse.Namespace) -> BaseMidibox:
     if args.osc_client:
         mb_backend = 'osc'
         mb_params['url'] = args.osc_client
+        mb_params['udp'] = args.osc_udp
+        mb_params['multicast'] = args.osc_multicast
     else:
         mb_backend = 'simulator' if args.simulator else backends.default_backend
 
@@ -44,7 +50,7 @@ def create_midibox_instance(args: argparse.Namespace) -> BaseMidibox:
     return backends.create_midibox_from_config(mb_backend, **mb_params)
 
 
-class MainOSCClientHandler(MidiboxOSCClientHandler, MidiplayerOSCClientHandler):
+class MainOSCClientHandler(MidiboxOSCClientHandler, MidiplayerOSCClientHandler, RecorderOSCClientHandler):
     pass
 
 
@@ -80,18 +86,24 @@ def main() -> None:
 
         mp = Midiplayer(midibox._output_port_name)
         mp.init()
-        mr = Recorder(midibox._input_port_name)
+        # ticks_per_beat, silence_gap, max_hold, max_size, max_duration, directory
+        mr = Recorder(midibox._input_port_name, **config.get("recorder", {}))
 
         midi_file = config.get("midiplayer", {}).get("autoload")
         if midi_file:
             mp.open(midi_file)
         MainOSCClientHandler.mp = mp
         MainOSCClientHandler.mb = midibox
-        osc_srv = TCPOSCServer(("0.0.0.0", args.osc_server_port), MainOSCClientHandler)
+        MainOSCClientHandler.mr = mr
+        udp = None
+        if args.osc_udp or args.osc_multicast:
+            udp = UDPOSCTransport(("0.0.0.0", args.osc_udp_port), multicast=args.osc_multicast)
+        osc_srv = TCPOSCServer(("0.0.0.0", args.osc_server_port), MainOSCClientHandler, coalesce_window=args.osc_coalesce_window, udp=udp)
         osc_srv.start()
         allowed_ips = None
         #allowed_ips = ['10.42.0.1']
-        zc = ZCPublisher(allowed_ips=allowed_ips, port=args.osc_server_port)
+        zc = ZCPublisher(allowed_ips=allowed_ips, port=args.osc_server_port,
+                         udp_port=udp.server_address[1] if udp else None, multicast_address=udp.multicast_address if udp else None)
 
     try:
         if args.gui:
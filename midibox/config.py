@@ -1,8 +1,12 @@
 from __future__ import annotations
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
 from types import SimpleNamespace
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Iterable, NamedTuple
 
-from .controller.base import GeneralProps, LayerProps, PedalProps
+from .controller.base import BaseMidibox, GeneralProps, LayerProps, PedalProps, PropHandler, RegisterImage
+from .controller.registers import get_diff_spans, serialize_image
 
 SAdict = dict[str, Any]
 
@@ -11,6 +15,31 @@ class NoFutherBaseException(Exception):
     pass
 
 
+PEDAL_MODES = {
+    'none': 0,
+    'normal': 1,
+    'note_length': 2,
+    'toggle_active': 3,
+    'push_active': 4,
+}
+
+
+class PresetProp(NamedTuple):
+    layer: int
+    pedal: Optional[int]
+    name: str
+    value: Any
+
+
+@dataclass(frozen=True)
+class FlatPreset():
+    """Preset with resolved inheritance: property values in the order of application"""
+    name: str
+    label: str
+    props: tuple[PresetProp, ...]
+    globals: tuple[tuple[str, Any], ...]  # Values of the `global` section
+
+
 def validate_config(config: dict[str, Any]) -> None:
     try:
         from schema import Schema, SchemaError, Optional, Or
@@ -71,6 +100,41 @@ def validate_config(config: dict[str, Any]) -> None:
         print(se)
 
 
+def _find_in_bases(root: Any, own: Callable[[Any], Optional[Any]]) -> Optional[Any]:
+    """First value found in the node or its bases, depth-first; cycles in bases are skipped"""
+    seen: set[int] = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        ret = own(node)
+        if ret is not None:
+            return ret
+        stack.extend(reversed(node._base))
+    return None
+
+
+def _parse_copy(copy: Any) -> list[dict[str, Any]]:
+    if isinstance(copy, list):
+        return copy
+    elif isinstance(copy, dict):
+        return [copy]
+    elif copy is None:
+        return [{}]
+    raise NotImplementedError()
+
+
+def _merge_layer(config: SAdict, src: SAdict) -> None:
+    for k, v in src.items():
+        if k == 'pedals':
+            for pi, pedal_config in v.items():
+                config['pedals'].setdefault(pi, {}).update(pedal_config)
+        else:
+            config[k] = v
+
+
 class PedalPreset():
     def __str__(self) -> str:
         return f"Pedal {self.layer} {self.index}"
@@ -88,18 +152,9 @@ class PedalPreset():
         self._presets = presets
 
         if "copy" in self._cfg.keys(): # value can be None
-            copy = self._cfg.get("copy")
-            if isinstance(copy, list):
-                base = copy
-            elif isinstance(copy, dict):
-                base = [copy]
-            elif copy is None:
-                base = [{}]
-            else:
-                raise NotImplementedError()
-
-            for copy in base:
-                preset = presets.get(copy.get("preset"), self.layer.preset)
+            for copy in _parse_copy(self._cfg.get("copy")):
+                name = copy.get("preset")
+                preset = self.layer.preset if name is None else presets.get(name, self.layer.preset)
                 preset.update_refs(presets)
                 layer = preset.get_layer(copy.get("layer", self.layer.index))
 
@@ -107,13 +162,19 @@ class PedalPreset():
                 assert pi >= 0
                 self._base.append(layer.get_pedal(pi))
 
-    def get_config(self, config: dict[str, Any]) -> None:
+    def deps(self) -> list[Any]:
+        return list(self._base)
+
+    def flatten(self, resolved: dict[Any, SAdict]) -> SAdict:
+        """Pedal config from the resolved configs of the bases"""
+        config: SAdict = {}
         for base in self._base:
-            base.get_config(config)
+            config.update(resolved[base])
 
         for k, v in self._cfg.items():
             if k in self.layer.preset._props.pedal:
                 config[k] = v
+        return config
 
 
 class LayerPreset():
@@ -145,18 +206,9 @@ class LayerPreset():
         self._presets = presets
 
         if "copy" in self._cfg.keys():
-            copy = self._cfg.get("copy")
-            if isinstance(copy, list):
-                base = copy
-            elif isinstance(copy, dict):
-                base = [copy]
-            elif copy is None:
-                base = [{}]
-            else:
-                raise NotImplementedError()
-
-            for copy in base:
-                preset = presets.get(copy.get("preset"), self.preset)
+            for copy in _parse_copy(self._cfg.get("copy")):
+                name = copy.get("preset")
+                preset = self.preset if name is None else presets.get(name, self.preset)
                 preset.update_refs(presets)
 
                 layer = copy.get("layer", self.index - (1 if preset == self.preset else 0))
@@ -166,42 +218,41 @@ class LayerPreset():
         for pedal in self._pedals.values():
             pedal.update_refs(presets)
 
-    def get_config(self, config: SAdict) -> None:
-        if config.get('pedals') is None:
-            config['pedals'] = {}
+    def deps(self) -> list[Any]:
+        return [*self._base, *self._pedals.values()]
 
+    def flatten(self, resolved: dict[Any, SAdict]) -> SAdict:
+        """Layer config from the resolved configs of the bases and own pedals"""
+        config: SAdict = {'pedals': {}}
         for base in self._base:
-            base.get_config(config)
+            _merge_layer(config, resolved[base])
 
         for k, v in self._cfg.items():
             if k in self.preset._props.layer:
                 config[k] = v
 
         for pedal in self._pedals.values():
-            if config['pedals'].get(pedal.index) is None:
-                config['pedals'][pedal.index] = {}
-            pedal.get_config(config['pedals'][pedal.index])
+            config['pedals'].setdefault(pedal.index, {}).update(resolved[pedal])
+        return config
 
     def get_pedal(self, index: int) -> PedalPreset:
-        if index in self._pedals:
-            return self._pedals[index]
-        for b in self._base:
-            try:
-                return b.get_pedal(index)
-            except NoFutherBaseException:
-                pass
-        raise NoFutherBaseException(f"No futher base to get pedal in {self}:{index}")
+        ret = _find_in_bases(self, lambda lr: lr._pedals.get(index))
+        if ret is None:
+            raise NoFutherBaseException(f"No futher base to get pedal in {self}:{index}")
+        return ret
 
 
 class Preset():
-    def __init__(self, cfg: SAdict, props: SimpleNamespace) -> None:
+    def __init__(self, cfg: SAdict, props: SimpleNamespace, name: str) -> None:
         self._cfg = cfg
-        self.name = cfg.get("name")
-        self.label = cfg.get("label")
+        self.name = name
+        self.label = str(cfg.get("label", ""))
         self._layers: dict[int, LayerPreset] = {}
         self._base: list[Preset] = []
         self._presets: Optional[dict[str, Preset]] = None
         self._props = props
+        # Resolved preset, None when the preset is part of or based on a cycle
+        self.flat: Optional[FlatPreset] = None
 
         for k, v in cfg.items():
             if k == 'layers':
@@ -238,33 +289,99 @@ class Preset():
             layer.update_refs(presets)
 
     def get_layer(self, index: int) -> LayerPreset:
-        if index in self._layers:
-            return self._layers[index]
-        for b in self._base:
-            try:
-                return b.get_layer(index)
-            except NoFutherBaseException:
-                pass
-        raise NoFutherBaseException(f"No futher base to get layer in {self}:{index}")
-
-    def get_config(self, config: dict[str, Any]) -> None:
-        if config.get('layers') is None:
-            config['layers'] = {}
+        ret = _find_in_bases(self, lambda p: p._layers.get(index))
+        if ret is None:
+            raise NoFutherBaseException(f"No futher base to get layer in {self}:{index}")
+        return ret
 
+    def deps(self) -> list[Any]:
+        return [*self._base, *self._layers.values()]
+
+    def flatten(self, resolved: dict[Any, SAdict]) -> SAdict:
+        """Preset config from the resolved configs of the bases and own layers"""
+        config: SAdict = {'layers': {}, 'global': {}}
         for base in self._base:
-            base.get_config(config)
+            bc = resolved[base]
+            for k, v in bc.items():
+                if k == 'layers':
+                    for li, layer_config in v.items():
+                        _merge_layer(config['layers'].setdefault(li, {'pedals': {}}), layer_config)
+                elif k == 'global':
+                    config['global'].update(v)
+                else:
+                    config[k] = v
 
         for k, v in self._cfg.items():
             if k in self._props.glob:
                 config[k] = v
+        config['global'].update(self._cfg.get('global') or {})
 
         for layer in self._layers.values():
-            if config['layers'].get(layer.index) is None:
-                config['layers'][layer.index] = {}
-            layer.get_config(config['layers'][layer.index])
+            _merge_layer(config['layers'].setdefault(layer.index, {'pedals': {}}), resolved[layer])
+        return config
+
+    def compile(self, config: SAdict) -> FlatPreset:
+        props: list[PresetProp] = []
+        for li, layer_config in sorted(config['layers'].items()):
+            for k, v in layer_config.items():
+                if k != 'pedals':
+                    props.append(PresetProp(li, None, k, v))
+            for pi, pedal_config in sorted(layer_config['pedals'].items()):
+                for k, v in pedal_config.items():
+                    if k == 'mode' and isinstance(v, str):
+                        v = PEDAL_MODES[v]
+                    props.append(PresetProp(li, pi, k, v))
+        return FlatPreset(self.name, self.label, tuple(props), tuple(config['global'].items()))
+
+
+def _resolve_order(nodes: Iterable[Any]) -> tuple[list[Any], list[list[Any]]]:
+    """Topological order of the nodes, bases first; nodes in or depending on a cycle are left out
+
+    Returns the order and the detected cycles.
+    """
+    order: list[Any] = []
+    cycles: list[list[Any]] = []
+    failed: set[int] = set()
+    done: set[int] = set()
+    for root in nodes:
+        if id(root) in done:
+            continue
+        stack = [(root, iter(root.deps()))]
+        visiting = {id(root)}
+        while stack:
+            node, it = stack[-1]
+            dep = next(it, None)
+            if dep is None:
+                stack.pop()
+                visiting.discard(id(node))
+                done.add(id(node))
+                if id(node) not in failed and any(id(d) in failed for d in node.deps()):
+                    failed.add(id(node))
+                if id(node) not in failed:
+                    order.append(node)
+            elif id(dep) in visiting:
+                path = [n for n, _ in stack]
+                cycle = path[path.index(dep):]
+                cycles.append(cycle)
+                failed.update(id(n) for n in cycle)
+            elif id(dep) not in done:
+                visiting.add(id(dep))
+                stack.append((dep, iter(dep.deps())))
+    return order, cycles
+
+
+# Presets of the last configuration, recompiled only when the configuration changes
+_compiled: Optional[tuple[str, dict[str, Preset]]] = None
 
 
 def presets_from_config(config: dict[str, Any]) -> dict[str, Preset]:
+    """Presets with resolved inheritance, see Preset.flat"""
+    global _compiled
+
+    key = json.dumps(config.get('presets', []), sort_keys=True, default=str)
+    if _compiled is not None and _compiled[0] == key:
+        return _compiled[1]
+
     props = SimpleNamespace(
         glob=[prop.name for prop in GeneralProps],
         layer=[prop.name for prop in LayerProps],
@@ -273,28 +390,101 @@ def presets_from_config(config: dict[str, Any]) -> dict[str, Preset]:
 
     validate_config(config)
 
-    # Sanitize input config
+    presets = {}
     for i, p in enumerate(config.get('presets', [])):
-        if p.get("name", None) is None:
-            p['name'] = f"__preset_{i}"
-    presets = {p["name"]: Preset(p, props) for p in config.get('presets', [])}
+        name = p.get("name") or f"__preset_{i}"
+        presets[name] = Preset(p, props, name)
 
     for p in presets.values():
         p.update_refs(presets)
 
-    if False: #: and (presets := config.get('presets')):
-        for p, preset in []: #enumerate(presets):
-            #presets = {preset.name: Preset(preset)}
-            li = 0
-            for layer in preset.get('layers', []):
-                # Override index
-                layer['__index'] = layer.get("layer", li)
-
-                pi = 0
-                for pedal in layer.get('pedals', []):
-                    pedal['__index'] = pedal.get("pedal", pi)
-                    pi = pedal['__index'] + 1
+    order, cycles = _resolve_order(presets.values())
+    for cycle in cycles:
+        print("Cycle in configuration:", " -> ".join(str(n) for n in cycle + cycle[:1]))
 
-                li = layer['__index'] + 1
+    resolved: dict[Any, SAdict] = {}
+    for node in order:
+        resolved[node] = node.flatten(resolved)
+        if isinstance(node, Preset):
+            node.flat = node.compile(resolved[node])
 
+    _compiled = (key, presets)
     return presets
+
+
+# Register write of a preset transition: block index, offset, register values
+RegisterWrite = tuple[int, int, bytes]
+
+
+class PresetTransitions():
+    """Register writes switching the device to a preset, cached in LRU order
+
+    The key is the register image before the switch and the target preset, so
+    a cached transition is used only when the device is exactly in the state
+    the transition was recorded from. Other switches apply the preset properties
+    and record the resulting register diff.
+    """
+    def __init__(self, mb: BaseMidibox, size: int = 64) -> None:
+        self._mb = mb
+        self._size = size
+        self._cache: OrderedDict[tuple[bytes, str], tuple[RegisterWrite, ...]] = OrderedDict()
+        # Presets setting only properties stored in the registers
+        self._registered: dict[str, bool] = {}
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._registered.clear()
+
+    def _is_registered(self, preset: FlatPreset) -> bool:
+        ret = self._registered.get(preset.name)
+        if ret is None:
+            mb = self._mb
+            ret = True
+            for layer, pedal, name, value in preset.props:
+                ph: PropHandler = mb.layers[layer] if pedal is None else mb.layers[layer].pedals[pedal]
+                if mb.register_field(ph, name) is None:
+                    ret = False
+                    break
+            self._registered[preset.name] = ret
+        return ret
+
+    def switch(self, preset: FlatPreset, apply: Callable[[FlatPreset], None]) -> None:
+        """Switch to the preset; `apply` sets the preset properties when no transition is cached"""
+        if not self._is_registered(preset):
+            apply(preset)
+            return
+        try:
+            image = self._mb.snapshot()
+        except NotImplementedError:
+            apply(preset)
+            return
+
+        key = (serialize_image(image), preset.name)
+        writes = self._cache.get(key)
+        if writes is not None:
+            self._cache.move_to_end(key)
+            if writes:
+                # Only the changed blocks are written and reloaded
+                target: RegisterImage = {}
+                for index, offset, data in writes:
+                    c = target.setdefault(index, image[index])
+                    c[offset:offset + len(data)] = data
+                self._mb.apply_snapshot(target, confirm=False)
+            return
+
+        apply(preset)
+        self._cache[key] = self.diff(image, self._mb.snapshot())
+        if len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def diff(old: RegisterImage, new: RegisterImage) -> tuple[RegisterWrite, ...]:
+        ret: list[RegisterWrite] = []
+        for index, c in sorted(new.items()):
+            orig = old.get(index)
+            if orig is None or len(orig) != len(c):
+                ret.append((index, 0, bytes(c)))
+                continue
+            for r in get_diff_spans(c, orig):
+                ret.append((index, r.start, bytes(c[r.start:r.stop])))
+        return tuple(ret)
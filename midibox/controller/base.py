@@ -1,9 +1,14 @@
+import os
+import threading
+
 import mido
 
 from pydispatch import Dispatcher
-from typing import NamedTuple, List, Any, Callable, Optional, Tuple, TypeVar, Sequence, Type
+from typing import NamedTuple, List, Any, Callable, Optional, Tuple, TypeVar, Sequence, Type, Iterable
 from types import TracebackType
 
+from .registers import Field, RegisterLayout, LAYER_LAYOUT, GENERAL_LAYOUT
+
 
 def clamp(val: int, lower: int, upper: int) -> int:
     return lower if val < lower else upper if val > upper else val
@@ -25,6 +30,9 @@ class Program(NamedTuple):
 
 T = TypeVar('T')
 
+# Register blocks of the device: layer index (general block is 15) -> register values
+RegisterImage = dict[int, bytearray]
+
 
 class PropHandler(Dispatcher):  # type: ignore[misc]
     _mb_properties: Sequence["CheckedProp[Any]"]
@@ -32,6 +40,8 @@ class PropHandler(Dispatcher):  # type: ignore[misc]
 
     def __init__(self, dev: "BaseMidibox", *args, **kwargs) -> None:  # type: ignore[no-untyped-def]
         self._dev = dev
+        # Device revision of the last change of each property
+        self._revisions: dict[str, int] = {}
         super().__init__(*args, **kwargs)
 
     def on_checkedprop_change(self, name: str, value: Any) -> None:
@@ -43,20 +53,51 @@ class PropHandler(Dispatcher):  # type: ignore[misc]
 
     def emit_control(self, name: str) -> None:
         kwargs = {name: getattr(self, name)}
-        self.emit('control_change', **kwargs)
+        self._emit(kwargs)
 
     def emit_all(self) -> None:
-        for ctrl in self._mb_properties:
-            kwargs = {ctrl.name: getattr(self, ctrl.name)}
+        self._emit({ctrl.name: getattr(self, ctrl.name) for ctrl in self._mb_properties})
+
+    def changes_since(self, revision: int) -> dict[str, Any]:
+        """Properties changed after the device revision"""
+        return {name: getattr(self, name) for name, rev in self._revisions.items() if rev > revision}
+
+    def revision_of(self, names: Iterable[str]) -> int:
+        return max((self._revisions.get(name, 0) for name in names), default=0)
+
+    def emit_change(self, **kwargs: Any) -> None:
+        """Emit control_change of changed values, the values get a new device revision"""
+        rev = self._dev.next_revision()
+        for name in kwargs:
+            self._revisions[name] = rev
+        self._emit(kwargs)
+
+    def _emit(self, kwargs: dict[str, Any]) -> None:
+        """Emit control_change, or collect the values while the device batches events"""
+        batch = self._dev._events_batch
+        if batch is not None:
+            batch.setdefault(self, {}).update(kwargs)
+        else:
             self.emit('control_change', **kwargs)
 
+    def load_props(self, values: dict[str, Any]) -> None:
+        """Store values received from the device, without validation and write back"""
+        changed = {}
+        for name, value in values.items():
+            _name = f'_{name}'
+            if value != getattr(self, _name):
+                setattr(self, _name, value)
+                changed[name] = value
+        if changed:
+            self.emit_change(**changed)
+
     def _on_checkedprop_change(self, cp: "CheckedProp[T]", value: Any) -> None:
         _name = f'_{cp.name}'
         value = cp.validator(self, value)
         if value != getattr(self, _name):
             setattr(self, _name, value)
             self.on_checkedprop_change(cp.name, value)
-            self.emit('control_change', **{cp.name: value})
+            self.emit_change(**{cp.name: value})
 
 
 class CheckedProp[T]:
@@ -223,11 +264,34 @@ class PropChange(NamedTuple):
     value: Any
 
 
+class EventBatchManager:
+    """Collects control_change events and delivers one multi-value event per handler on exit"""
+    def __init__(self, request_handler: "BaseMidibox"):
+        self._mb = request_handler
+
+    def __enter__(self) -> None:
+        if self._mb._events_inner == 0:
+            self._mb._events_batch = {}
+        self._mb._events_inner += 1
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> Optional[bool]:
+        self._mb._events_inner -= 1
+        if self._mb._events_inner == 0:
+            batch = self._mb._events_batch
+            self._mb._events_batch = None
+            if batch:
+                for ph, kwargs in batch.items():
+                    ph.emit('control_change', **kwargs)
+        return None
+
+
 class BundleManager:
     def __init__(self, request_handler: "BaseMidibox"):
         self._mb = request_handler
+        self._events = EventBatchManager(request_handler)
 
     def __enter__(self) -> None:
+        self._events.__enter__()
         if self._mb._bundle_inner == 0:
             self._mb._bundle = None
             self._mb._bundle = []
@@ -235,11 +299,14 @@ class BundleManager:
 
     def __exit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> Optional[bool]:
         self._mb._bundle_inner -= 1
-        if self._mb._bundle_inner == 0:
-            if self._mb._bundle:
-                bundle = self._mb._bundle
-                self._mb._bundle = None
-                self._mb.set_props(bundle)
+        try:
+            if self._mb._bundle_inner == 0:
+                if self._mb._bundle:
+                    bundle = self._mb._bundle
+                    self._mb._bundle = None
+                    self._mb.set_props(bundle)
+        finally:
+            self._events.__exit__(exc_type, exc, traceback)
         return None
 
 
@@ -267,14 +334,24 @@ class BaseMidibox():
         'Push Active': 4,
     }
 
+    # Register block index of the general block, layers use their index
+    _LAYER_GENERAL = 15
+
     layers: List[Layer]
 
     _bundle: Optional[list[PropChange]]
     _bundle_inner: int
+    _events_batch: Optional[dict[PropHandler, dict[str, Any]]]
+    _events_inner: int
 
     def __init__(self) -> None:
         super().__init__()
 
+        # Property changes are versioned by the revision, the epoch identifies this state instance
+        self.epoch = int.from_bytes(os.urandom(4), byteorder='big') & 0x7FFFFFFF
+        self.revision = 0
+        self._revision_lock = threading.Lock()
+
         self.layers = [Layer(self, i) for i in range(8)]
         self.general = General(self)
         self._callbacks: list[Callable[[mido.Message], None]] = []
@@ -282,6 +359,13 @@ class BaseMidibox():
         self._requestKey: Optional[Tuple[str, int, str]] = None
         self._bundle = None
         self._bundle_inner = 0
+        self._events_batch = None
+        self._events_inner = 0
+
+    def next_revision(self) -> int:
+        with self._revision_lock:
+            self.revision += 1
+            return self.revision
 
     def disconnect(self) -> None:
         pass
@@ -290,9 +374,10 @@ class BaseMidibox():
         pass
 
     def emit_all(self) -> None:
-        self.general.emit_all()
-        for lr in self.layers:
-            lr.emit_all()
+        with self.batch_events():
+            self.general.emit_all()
+            for lr in self.layers:
+                lr.emit_all()
 
     def reset(self) -> None:
         self.general.reset()
@@ -308,6 +393,9 @@ class BaseMidibox():
     def bundle(self) -> BundleManager:
         return BundleManager(self)
 
+    def batch_events(self) -> EventBatchManager:
+        return EventBatchManager(self)
+
     def set_prop(self, source: PropHandler, name: str, value: Any) -> None:
         pc = PropChange(source, name, value)
         if self._bundle is not None:
@@ -318,6 +406,60 @@ class BaseMidibox():
     def set_props(self, props: list[PropChange]) -> None:
         raise NotImplementedError
 
+    def _block_handler(self, layer: int) -> Optional[PropHandler]:
+        if layer < len(self.layers):
+            return self.layers[layer]
+        elif layer == self._LAYER_GENERAL:
+            return self.general
+        return None
+
+    def _block_layout(self, layer: int) -> RegisterLayout:
+        return GENERAL_LAYOUT if layer == self._LAYER_GENERAL else LAYER_LAYOUT
+
+    def register_field(self, ph: PropHandler, name: str) -> Optional[Field]:
+        """Register field storing the property, None for properties not stored in the device"""
+        if isinstance(ph, Pedal):
+            return LAYER_LAYOUT.field(name, ph._index)
+        elif isinstance(ph, Layer):
+            return LAYER_LAYOUT.field(name)
+        elif isinstance(ph, General):
+            return GENERAL_LAYOUT.field(name)
+        return None
+
+    def load_block(self, layer: int, c: bytearray | bytes, fields: Optional[list[Field]] = None) -> None:
+        """Load property values from the register block"""
+        values = self._block_layout(layer).decode(c, fields)
+        grp = self._block_handler(layer)
+        for pedal, v in values.items():
+            if pedal is None:
+                assert grp is not None
+                grp.load_props(v)
+            else:
+                self.layers[layer].pedals[pedal].load_props(v)
+
+    def encode_image(self, image: Optional[RegisterImage] = None) -> RegisterImage:
+        """Register blocks with the current property values; bytes not covered by fields are taken from `image`"""
+        ret: RegisterImage = {}
+        for layer in [self._LAYER_GENERAL] + [lr._index for lr in self.layers]:
+            layout = self._block_layout(layer)
+            grp = self._block_handler(layer)
+            orig = image.get(layer) if image is not None else None
+            c = orig.copy() if orig is not None and len(orig) == layout.size else bytearray(layout.size)
+            for f in layout.fields:
+                f.encode(c, getattr(grp if f.pedal is None else self.layers[layer].pedals[f.pedal], f.name))
+            ret[layer] = c
+        return ret
+
+    def snapshot(self) -> RegisterImage:
+        raise NotImplementedError
+
+    def apply_snapshot(self, image: RegisterImage, confirm: bool = True) -> bool:
+        """Write the target register image of the general block and layers in one transaction
+
+        Returns True when the device confirmed all writes (always True for confirm=False).
+        """
+        raise NotImplementedError
+
     def sendmsg(self, msg: mido.Message) -> None:
         raise NotImplementedError
 
@@ -0,0 +1,173 @@
+import re
+
+from typing import Any, Optional, Sequence, Iterable
+
+
+# Register values read by decode; encode writes into a MutableRegisterBuffer
+RegisterBuffer = bytearray | bytes | memoryview | list[int]
+MutableRegisterBuffer = bytearray | list[int]
+
+
+class Field():
+    """Property stored in the device register block, see struct layer_state_reg in hw-common/api.h"""
+    size = 1
+
+    def __init__(self, name: str, offset: int, pedal: Optional[int] = None) -> None:
+        self.name = name
+        self.offset = offset
+        self.pedal = pedal  # Index of the owning pedal in layer block
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r}, {self.offset}, pedal={self.pedal})"
+
+    def decode(self, c: RegisterBuffer) -> Any:
+        raise NotImplementedError
+
+    def encode(self, c: MutableRegisterBuffer, value: Any) -> None:
+        raise NotImplementedError
+
+
+class ByteField(Field):
+    def __init__(self, name: str, offset: int, bias: int = 0, pedal: Optional[int] = None) -> None:
+        super().__init__(name, offset, pedal)
+        self.bias = bias
+
+    def decode(self, c: RegisterBuffer) -> int:
+        return c[self.offset] - self.bias
+
+    def encode(self, c: MutableRegisterBuffer, value: int) -> None:
+        c[self.offset] = (value + self.bias) & 0x7F
+
+
+class FlagField(Field):
+    def __init__(self, name: str, offset: int, bit: int) -> None:
+        super().__init__(name, offset)
+        self.mask = 1 << bit
+
+    def decode(self, c: RegisterBuffer) -> bool:
+        return True if c[self.offset] & self.mask else False
+
+    def encode(self, c: MutableRegisterBuffer, value: bool) -> None:
+        if value:
+            c[self.offset] |= self.mask
+        else:
+            c[self.offset] &= ~self.mask & 0xFF
+
+
+class ProgramField(Field):
+    """Program change, bank select MSB and LSB; the program ident is `_pgm_{pc}_{msb}_{lsb}_`"""
+    size = 3
+    _regex = re.compile(r"_pgm_(\d+)_(\d+)_(\d+)_")
+
+    def decode(self, c: RegisterBuffer) -> str:
+        o = self.offset
+        return f"_pgm_{c[o] + 1}_{c[o + 1]}_{c[o + 2]}_"
+
+    def encode(self, c: MutableRegisterBuffer, value: str) -> None:
+        m = self._regex.fullmatch(value) if isinstance(value, str) else None
+        if m is None:
+            return
+        pc, msb, lsb = (int(g) for g in m.groups())
+        o = self.offset
+        c[o:o + 3] = bytes([(pc - 1) & 0x7F, msb & 0x7F, lsb & 0x7F])
+
+
+def get_diff_spans(a: Sequence[int], b: Sequence[int], gap: int = 0) -> list[range]:
+    """Ranges of differing items; ranges separated by up to `gap` equal items are merged"""
+    spans: list[range] = []
+    start = last = -1
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x == y:
+            continue
+        if start < 0 or i - last - 1 > gap:
+            if start >= 0:
+                spans.append(range(start, last + 1))
+            start = i
+        last = i
+    if start >= 0:
+        spans.append(range(start, last + 1))
+    return spans
+
+
+class RegisterLayout():
+    def __init__(self, size: int, fields: Sequence[Field]) -> None:
+        self.size = size
+        self.fields = fields
+        self._by_name = {(f.name, f.pedal): f for f in fields}
+
+        # Fields covering each register byte
+        self._by_byte: list[tuple[Field, ...]] = [()] * size
+        for f in fields:
+            for i in range(f.offset, f.offset + f.size):
+                self._by_byte[i] += (f,)
+
+    def field(self, name: str, pedal: Optional[int] = None) -> Optional[Field]:
+        return self._by_name.get((name, pedal))
+
+    def changed(self, old: RegisterBuffer, new: RegisterBuffer, offset: int = 0) -> list[Field]:
+        """Fields with modified bytes; `new` are register values starting at `offset`"""
+        ret: list[Field] = []
+        for i, val in enumerate(new, offset):
+            if old[i] != val:
+                for f in self._by_byte[i]:
+                    if f not in ret:
+                        ret.append(f)
+        return ret
+
+    def decode(self, c: RegisterBuffer, fields: Optional[Iterable[Field]] = None) -> dict[Optional[int], dict[str, Any]]:
+        """Decode fields into values grouped by the owner pedal index (None for layer / general)"""
+        ret: dict[Optional[int], dict[str, Any]] = {}
+        for f in self.fields if fields is None else fields:
+            ret.setdefault(f.pedal, {})[f.name] = f.decode(c)
+        return ret
+
+
+LAYER_LAYOUT = RegisterLayout(44, [
+    FlagField('enabled', 0, 0),
+    FlagField('active', 0, 1),
+    ProgramField('program', 3),
+    ByteField('rangel', 6),
+    ByteField('rangeu', 7),
+    ByteField('volume', 8),
+    ByteField('transposition', 10, bias=64),
+    ByteField('transposition_extra', 11, bias=64),
+    ByteField('release', 12, bias=64),
+    ByteField('attack', 13, bias=64),
+    ByteField('cutoff', 14, bias=64),
+    ByteField('decay', 15, bias=64),
+    *[ByteField('cc', 16 + i, pedal=i) for i in range(8)],
+    *[ByteField('mode', 24 + i, pedal=i) for i in range(8)],
+    ByteField('percussion', 32),
+    *[ByteField(f'harmonic_bar{i}', 33 + i) for i in range(9)],
+    ByteField('portamento_time', 42),
+    ByteField('volume_ch', 43),
+])
+
+GENERAL_LAYOUT = RegisterLayout(6 + 16 + 16, [
+    FlagField('enable', 0, 0),
+    *[ByteField(f'pedal_cc{i}', 6 + i) for i in range(8)],
+    *[ByteField(f'pedal_mode{i}', 14 + i) for i in range(8)],
+    *[ByteField(f'pedal_min{i}', 22 + i) for i in range(8)],
+    *[ByteField(f'pedal_max{i}', 30 + i) for i in range(8)],
+])
+
+
+def serialize_image(image: dict[int, bytearray]) -> bytes:
+    """Register blocks as a sequence of: block index, size, register values"""
+    ret = bytearray()
+    for index, c in sorted(image.items()):
+        ret += bytes([index, len(c)])
+        ret += c
+    return bytes(ret)
+
+
+def parse_image(data: bytes | memoryview) -> dict[int, bytearray]:
+    image: dict[int, bytearray] = {}
+    pos = 0
+    while pos + 2 <= len(data):
+        index, size = data[pos], data[pos + 1]
+        if pos + 2 + size > len(data):
+            raise ValueError("Truncated register image")
+        image[index] = bytearray(data[pos + 2:pos + 2 + size])
+        pos += 2 + size
+    return image
@@ -2,20 +2,20 @@
 import time
 import io
 import threading
-import queue
 import mido
 
-from typing import Optional, Callable, Tuple, Iterable
+from typing import Optional, Callable
+
+from .timeline import Timeline
 
-import dataclasses
 from dataclasses import dataclass
 
 
 def now() -> float:
-    return time.time()
+    return time.perf_counter()
 
 
-@dataclass
+@dataclass(slots=True)
 class MidiplayerStatus():
     total_time: float = 0
     current_time: float = 0  # Current time from beggining of the midi file
@@ -27,40 +27,42 @@ class MidiplayerStatus():
 
 @dataclass
 class MidiplayerState():
-    midi_iter: Iterable[mido.Message]
     total_time: float = 0
-    next_event: float = 0 # Absolute time of next event from input file iterator
-    #abs_beat: int = 0
+    next_event: float = 0 # Absolute time of next event
+    index: int = 0  # Next event in the timeline
+    beat_index: int = 0  # Current beat in the timeline
 
     speed: float = 1.0  # Relative speed change
     ct_measure: int = 1
     ct_beat: int = 1
-    ct_tempo: int = 500000
-    ct_bpm: Optional[int] = None
-    #ct_tempo_time: float = 0 # Last time when tempo or time_signature changed
-    ts: Tuple[int, int] = (4, 4)
-    #ts_beat: int = 0 # Relative beat count from last time_signature change
-    next_beat_reltime: Optional[float] = None
     global_time: Optional[float] = None
 
     _paused: Optional[float] = None
     current_time_offset: float = 0
-    beat_time: float = 0
 
 
 class Midiplayer():
-    def __init__(self, port: str):
+    def __init__(self, port: str, status_rate: float = 20):
         self._port_name = port
         self._midifile = None
-        self._seek_state: MidiplayerState = MidiplayerState(iter(()))
+        self._timeline: Optional[Timeline] = None
+        self._seek_state: MidiplayerState = MidiplayerState()
 
         self._stop = threading.Event()
         self._pause = threading.Event()
         self._seek = threading.Event()
+        # Notified on every change of the events above, the player thread waits on it
+        self._wakeup = threading.Condition()
         self.update_cbs: list[Callable[[MidiplayerStatus], None]] = []
-        self._update_queue: queue.Queue[MidiplayerStatus] = queue.Queue()
-
-        self._playing_notes: dict[Tuple[int, int], int] = {}
+        # Latest status is published in self.status, the update thread delivers it to update_cbs
+        self._status_ready = threading.Event()
+        self._status_period = 1 / status_rate
+        self._next_publish: float = 0
+
+        # Notes and controller values sent by the player: channel * 128 + note / controller
+        self._active_notes = bytearray(16 * 128)
+        self._active_count = 0
+        self._controllers = bytearray(16 * 128)
         self._tpb = 480
 
         self.status = MidiplayerStatus()
@@ -72,14 +74,26 @@ class Midiplayer():
     def init(self) -> None:
         self._output = mido.open_output(self._port_name)
 
+        # Raw bytes are written directly to the rtmidi port when the backend exposes it
+        rt = getattr(self._output, '_rt', None)
+        self._send_raw: Callable[[bytes], None] = rt.send_message if rt is not None and hasattr(rt, 'send_message') else self._send_bytes
+
         self._thread = threading.Thread(target=self._run)
         self._thread.start()
 
         self._update_thread = threading.Thread(target=self._update_func)
         self._update_thread.start()
 
+    def _notify(self, event: threading.Event, value: bool = True) -> None:
+        with self._wakeup:
+            if value:
+                event.set()
+            else:
+                event.clear()
+            self._wakeup.notify_all()
+
     def destroy(self) -> None:
-        self._stop.set()
+        self._notify(self._stop)
         self._thread.join()
         self._update_thread.join()
 
@@ -93,15 +107,13 @@ class Midiplayer():
         if not self.is_paused() == play:
             return
 
-        if play:
-            self._pause.clear()
-        else:
-            self._pause.set()
+        self._notify(self._pause, not play)
 
     def open(self, filename: str) -> None:
         self._midifile = mido.MidiFile(filename, ticks_per_beat=self._tpb)
         if self._midifile is None:
             return
+        self._timeline = Timeline(self._midifile)
         self.rewind()
 
     def load(self, data: bytes) -> None:
@@ -109,6 +121,7 @@ class Midiplayer():
         self._midifile = mido.MidiFile(file=file, ticks_per_beat=self._tpb)
         if self._midifile is None:
             return
+        self._timeline = Timeline(self._midifile)
         self.rewind()
 
     def rewind(self):
@@ -116,183 +129,183 @@ class Midiplayer():
         self.seek(0)
 
     def seek(self, timestamp: float | None = None, measure: Optional[int] = None) -> None:
-        if self._midifile is None:
+        tl = self._timeline
+        if tl is None:
             return
 
-        st = MidiplayerState(iter(self._midifile))
-        st.total_time = self._midifile.length
-
-        temp_iter: Iterable[mido.MidiMessage] = iter(self._midifile)
-        for msg in temp_iter:
-            pt = st.next_event * 1_000_000
-            self._advance_beat(pt, st)
+        if measure is not None:
+            timestamp = tl.measure_time(measure)
+            if timestamp is None:
+                timestamp = tl.length
+        elif timestamp is None:
+            timestamp = 0
 
-            if \
-                    (timestamp is not None and st.next_event > timestamp) or \
-                    (measure is not None and st.ct_measure == measure):
-                break
-
-            st.next_event += msg.time
-
-            if isinstance(msg, mido.MetaMessage):
-                self._handle_msg_meta(st.next_event, st, msg)
-            next(st.midi_iter)
+        st = MidiplayerState()
+        st.total_time = tl.length
+        st.next_event = timestamp
+        st.index = tl.event_index(timestamp)
+        st.beat_index = tl.beat_index(timestamp)
+        st.ct_measure, st.ct_beat = tl.beats[st.beat_index]
 
         self._seek_state = st
-        self._seek.set()
+        self._notify(self._seek)
+
+    # Sustain, sostenuto and soft pedal are released together with the notes
+    _PEDALS = (64, 66, 67)
 
     def _stop_all_playing_notes(self) -> None:
-        # FIXME: send AllNotesOff(), because user can play too
-        self._output.reset()
-
-        for c in set([channel for (note, channel), vel in self._playing_notes.items()]):
-            self._output.send(mido.Message('control_change', channel=c, control=120, value=0))
-            #self._output.send(mido.Message('note_off', channel=c, note=note, velocity=0))
-        self._playing_notes.clear()
-
-    def _handle_msg(self, pt: float, st: MidiplayerState, msg: mido.Message) -> None:
-        if isinstance(msg, mido.MetaMessage):
-            self._handle_msg_meta(pt, st, msg)
-        else:
-            self._handle_msg_nonmeta(msg)
-
-    def _handle_msg_nonmeta(self, msg: mido.Message) -> None:
-        if not isinstance(msg, mido.MetaMessage):
-            if msg.type == 'note_on' and msg.velocity == 0:
-                msg.type = 'note_off'
-
-            if msg.type == 'note_on':
-                note = (msg.note, msg.channel)
-                self._playing_notes.update({note: msg.velocity})
-            elif msg.type == 'note_off':
-                note = (msg.note, msg.channel)
-                if note in self._playing_notes:
-                    del self._playing_notes[note]
-
-            if True or msg.type in ['note_on', 'note_off', 'control_change', 'program_change']:
-                self._output.send(msg)
-
-    def _handle_msg_meta(self, pt: float, st: MidiplayerState, msg: mido.Message) -> None:
-        if msg.type == 'time_signature':
-            st.ts = (msg.numerator, msg.denominator)
-            #print("TS:", st.ts)
-            #st.ts_beat = st.abs_beat
-        elif msg.type == 'set_tempo':
-            # Current beat relative position (percent)
-            #rel_position = (pt - st.beat_time) / st.ct_tempo
-            #beat_time = pt - rel_position * msg.tempo
-            #print("Tempo", mido.tempo2bpm(msg.tempo))
-            st.beat_time = (msg.tempo * (st.beat_time - pt) + st.ct_tempo * pt) / st.ct_tempo
-            st.ct_tempo = msg.tempo
+        """Note off for the notes of the player only, the notes played live are kept"""
+        msgs = []
+        if self._active_count:
+            i = self._active_notes.find(1)
+            while i >= 0:
+                msgs.append(bytes([0x80 | (i >> 7), i & 0x7F, 0]))
+                i = self._active_notes.find(1, i + 1)
+            self._active_notes[:] = bytes(len(self._active_notes))
+            self._active_count = 0
+
+        for ch in range(16):
+            for cc in self._PEDALS:
+                if self._controllers[ch * 128 + cc]:
+                    self._controllers[ch * 128 + cc] = 0
+                    msgs.append(bytes([0xB0 | ch, cc, 0]))
+
+        for data in msgs:
+            self._send_raw(data)
+
+    def _restore_controllers(self, st: MidiplayerState) -> None:
+        tl = self._timeline
+        assert tl is not None
+        for data in tl.controller_state(st.index):
+            self._handle_event(data)
+
+    def _send_bytes(self, data: bytes) -> None:
+        self._output.send(mido.Message.from_bytes(data))
+
+    def _handle_event(self, data: bytes) -> None:
+        status = data[0] & 0xF0
+        if status == 0x90:
+            i = (data[0] & 0x0F) << 7 | data[1]
+            if not self._active_notes[i]:
+                self._active_notes[i] = 1
+                self._active_count += 1
+        elif status == 0x80:
+            i = (data[0] & 0x0F) << 7 | data[1]
+            if self._active_notes[i]:
+                self._active_notes[i] = 0
+                self._active_count -= 1
+        elif status == 0xB0:
+            self._controllers[(data[0] & 0x0F) << 7 | data[1]] = data[2]
+
+        self._send_raw(data)
 
     def _update_func(self) -> None:
         while not self._stop.is_set():
-            try:
-                item = self._update_queue.get(timeout=0.5)
-            except queue.Empty:
+            if not self._status_ready.wait(timeout=0.5):
                 continue
+            self._status_ready.clear()
 
+            status = self.status
             for cb in self.update_cbs:
-                cb(item)
-
-    def _update_cbs(self, status: MidiplayerStatus) -> None:
-        self.status = dataclasses.replace(status)
-        while True:
-            try:
-                _ = self._update_queue.get(timeout=0)
-            except queue.Empty:
-                break
+                cb(status)
+
+    def _publish(self, st: MidiplayerState, current_time: float, playing: bool, force: bool = False) -> None:
+        """Publish status on beat change, otherwise at most status_rate times per second"""
+        t = now()
+        last = self.status
+        if not force and t < self._next_publish and \
+                (last.measure, last.beat, last.playing) == (st.ct_measure, st.ct_beat, playing):
+            return
 
-        self._update_queue.put_nowait(self.status)
+        self._next_publish = t + self._status_period
+        self.status = MidiplayerStatus(st.total_time, current_time, playing, self.is_paused(), st.ct_measure, st.ct_beat)
+        self._status_ready.set()
 
     def _run(self) -> None:
         while not self._stop.is_set():
-            if not self._seek.is_set():
-                time.sleep(0.01)
-                continue
-
-            self._seek.clear()
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._stop.is_set() or self._seek.is_set())
+                if self._stop.is_set():
+                    break
+                self._seek.clear()
             ss = self._seek_state
 
             self._do_play(ss)
             self._stop_all_playing_notes()
 
-    def _do_pause(self, status: MidiplayerStatus, st: MidiplayerState) -> bool:
-        if self._pause.is_set():
-            if st._paused is None:
-                self._stop_all_playing_notes()
-                st._paused = now()
-                status.paused = True
-                self._update_cbs(status)
-            return True
+    def _do_pause(self, st: MidiplayerState) -> None:
+        """Wait while paused, the playback time stands still"""
+        self._stop_all_playing_notes()
+        st._paused = now()
+        self._publish(st, st._paused - st.current_time_offset, True, force=True)
 
-        if st._paused is not None:
-            st.current_time_offset += now() - st._paused
-            st._paused = None
+        with self._wakeup:
+            self._wakeup.wait_for(lambda: not self._pause.is_set() or not self._can_play())
 
-        status.paused = False
-
-        self._update_cbs(status)
-        return False
+        st.current_time_offset += now() - st._paused
+        st._paused = None
+        self._publish(st, now() - st.current_time_offset, True, force=True)
+        if self._can_play():
+            self._restore_controllers(st)
 
     def _can_play(self) -> bool:
         return not (self._stop.is_set() or self._seek.is_set())
 
-    def _advance_beat(self, pt: float, st: MidiplayerState) -> bool:
-        mod = False
-        while pt - st.beat_time > st.ct_tempo:
-            st.beat_time += st.ct_tempo
-            #st.abs_beat += 1
-            st.ct_beat += 1
-            mod = True
-            # FIXME: compute with denominators other than 4
-            if st.ct_beat > st.ts[0]:
-                st.ct_beat = 1
-                st.ct_measure += 1
-        return mod
+    def _advance_beat(self, playback_time: float, st: MidiplayerState) -> bool:
+        tl = self._timeline
+        assert tl is not None
+        index = st.beat_index
+        while index + 1 < len(tl.beat_times) and tl.beat_times[index + 1] <= playback_time:
+            index += 1
+        if index == st.beat_index:
+            return False
+        st.beat_index = index
+        st.ct_measure, st.ct_beat = tl.beats[index]
+        return True
 
     def _do_play(self, st: MidiplayerState):
-        msg: Optional[mido.Message] = None
+        tl = self._timeline
+        if tl is None:
+            return
+
         st.current_time_offset = now() - st.next_event
         #print(f"{st.ct_measure}.{st.ct_beat}")
 
-        status = MidiplayerStatus(st.total_time, st.next_event, False, self.is_paused(), st.ct_measure, st.ct_beat)
-
-        self._update_cbs(status)
+        self._publish(st, st.next_event, False, force=True)
+        if not self._pause.is_set():
+            self._restore_controllers(st)
         while self._can_play():
-            if self._do_pause(status, st):
-                time.sleep(0.01)
+            if self._pause.is_set():
+                self._do_pause(st)
                 continue
 
-            if msg is None:
-                try:
-                    msg = next(st.midi_iter) #type: ignore
-                except StopIteration:
-                    self.rewind()
-                    break
-                st.next_event += msg.time
+            if st.index >= len(tl):
+                self.rewind()
+                break
+
             playback_time = now() - st.current_time_offset
 
-            pt = playback_time * 1_000_000
-            if self._advance_beat(pt, st):
+            # Dispatch all due events in one pass
+            while st.index < len(tl) and tl.times[st.index] <= playback_time:
+                st.next_event = tl.times[st.index]
+                self._handle_event(tl.events[st.index])
+                st.index += 1
+
+            if self._advance_beat(playback_time, st):
                 #print(f"{st.ct_measure}.{st.ct_beat}")
                 if self.jumps:
                     (cm, cb), (nm, nb) = self.jumps[0]
                     if (cm, cb) == (st.ct_measure, st.ct_beat):
                         self.seek(measure=nm)
 
-            status = MidiplayerStatus(st.total_time, st.next_event, False, self.is_paused(), st.ct_measure, st.ct_beat)
-
-            status.playing = True
-            status.current_time = playback_time
-            status.measure = st.ct_measure
-            status.beat = st.ct_beat
-            self._update_cbs(status)
-
-            duration_to_next_event = st.next_event - playback_time
-            if duration_to_next_event > 0.0:
-                time.sleep(min(duration_to_next_event, 0.01))
-                continue
-
-            self._handle_msg(pt, st, msg)
-            msg = None
+            self._publish(st, playback_time, True)
+
+            # Sleep until the next event, beat or status update, any control change wakes the player
+            deadline = tl.times[st.index] if st.index < len(tl) else tl.length
+            if st.beat_index + 1 < len(tl.beat_times):
+                deadline = min(deadline, tl.beat_times[st.beat_index + 1])
+            deadline = min(deadline, self._next_publish - st.current_time_offset)
+            timeout = deadline - (now() - st.current_time_offset)
+            if timeout > 0:
+                with self._wakeup:
+                    self._wakeup.wait_for(lambda: self._pause.is_set() or not self._can_play(), timeout)
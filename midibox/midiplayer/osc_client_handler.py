@@ -1,37 +1,72 @@
 import dataclasses
+import threading
+import weakref
 
-from ..osc.server import DispatchedOSCRequestHandler
+from typing import Tuple
+
+from ..osc.server import DispatchedOSCRequestHandler, DispatcherMaps
 from .midiplayer import Midiplayer, MidiplayerStatus
 
 
-class MidiplayerOSCClientHandler(DispatchedOSCRequestHandler):
-    mp: Midiplayer
+class MidiplayerOSCFanout():
+    """Single subscriber of Midiplayer status for all connected clients
 
-    def setup(self) -> None:
-        super().setup()
+    Stream updates are sent once per status for all clients, see TCPOSCServer.send_stream.
+    """
+    _instances: "weakref.WeakKeyDictionary[Midiplayer, MidiplayerOSCFanout]" = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
 
-        self._mp_time: float = 0
+    @classmethod
+    def get(cls, mp: Midiplayer) -> "MidiplayerOSCFanout":
+        with cls._instances_lock:
+            fanout = cls._instances.get(mp)
+            if fanout is None:
+                fanout = cls._instances[mp] = cls(mp)
+            return fanout
+
+    def __init__(self, mp: Midiplayer) -> None:
+        self.mp = mp
+        self.clients: Tuple["MidiplayerOSCClientHandler", ...] = ()
+        self._lock = threading.Lock()
 
-        self.mp.update_cbs.append(self.mp_update_cb)
-        self.__init_dispatcher()
+        self._mp_time: float = 0
         self._last_status: MidiplayerStatus | None = None
-        #self._last_status = self.mp.status.copy()
-        self.mp_update_cb(self.mp.status)
 
-    def __init_dispatcher(self) -> None:
-        # Player section
-        self.map("/player/play", lambda addr, x: self.play())
-        self.map("/player/seek", lambda addr, x: self.seek(x))
-        self.map("/player/load", lambda addr, x: self.load(x))
+    def add(self, client: "MidiplayerOSCClientHandler") -> None:
+        with self._lock:
+            if not self.clients:
+                self.mp.update_cbs.append(self.mp_update_cb)
+            self.clients += (client,)
+
+        status = self.mp.status
+        length: float = 1 if status.total_time is None else status.total_time
+        time: float = 0 if status.current_time is None else status.current_time
+        client.send_state("/player/play", not status.paused)
+        if length > 0:
+            client.send_state("/player/seek", time / length)
+        client.send_state("/player/measure", status.measure, status.beat)
+
+    def remove(self, client: "MidiplayerOSCClientHandler") -> None:
+        with self._lock:
+            if client not in self.clients:
+                return
+            self.clients = tuple(c for c in self.clients if c is not client)
+            if not self.clients:
+                self.mp.update_cbs.remove(self.mp_update_cb)
+                self._last_status = None
 
     def mp_update_cb(self, status: MidiplayerStatus) -> None:
+        clients = self.clients
+        if not clients:
+            return
+
         if self._last_status is None or self._last_status.paused != status.paused:
-            self.send_message("/player/play", not status.paused)
+            for c in clients:
+                c.send_state("/player/play", not status.paused)
 
         time: float = 0 if status.current_time is None else status.current_time
         length: float = 1 if status.total_time is None else status.total_time
 
-        #print("Seeking  to ", (time/length )if length > 0 else "X", time)
         if length > 0 and abs(self._mp_time - time) > 0.5 or (
                 self._last_status is not None and (
                 self._last_status.measure != status.measure or
@@ -39,21 +74,43 @@ class MidiplayerOSCClientHandler(DispatchedOSCRequestHandler):
             ):
 
             self._mp_time = time
-            #self.send_message("/player/pos", time / length)
-            self.send_message("/player/seek", time / length)
-            self.send_message("/player/measure", status.measure, status.beat)
+            server = clients[0].server
+            server.send_stream("/player/seek", (time / length,), clients)
+            server.send_stream("/player/measure", (status.measure, status.beat), clients)
 
         self._last_status = dataclasses.replace(status)
 
+
+class MidiplayerOSCClientHandler(DispatchedOSCRequestHandler):
+    mp: Midiplayer
+
+    def setup(self) -> None:
+        super().setup()
+
+        self._mp_fanout = MidiplayerOSCFanout.get(self.mp)
+        self._mp_fanout.add(self)
+
+    @classmethod
+    def init_shared_dispatcher(cls, maps: DispatcherMaps) -> None:
+        super().init_shared_dispatcher(maps)
+        # Player section
+        maps["/player/play"] = (lambda self, addr, x: self.play(), ())
+        maps["/player/seek"] = (lambda self, addr, x: self.seek(x), ())
+        maps["/player/load"] = (lambda self, addr, x: self.load(x), ())
+
+    def finish(self) -> None:
+        self._mp_fanout.remove(self)
+        super().finish()
+
     def load(self, x) -> None:
         self.mp.load(bytes(x))
 
     def seek(self, x: float) -> None:
-        if self._last_status is None or self._last_status.total_time == 0:
+        status = self.mp.status
+        if status.total_time == 0:
             return
 
-        #print("Seek to ", x, x * self._last_status.total_time)
-        self.mp.seek(x * self._last_status.total_time)
+        self.mp.seek(x * status.total_time)
 
     def play(self) -> None:
         self.mp.play(self.mp.is_paused())
@@ -0,0 +1,148 @@
+import bisect
+import heapq
+import mido
+
+from typing import Optional, Tuple, Iterator
+
+
+def _merge_tracks(tracks: list[mido.MidiTrack]) -> Iterator[Tuple[int, mido.Message]]:
+    """Messages of all tracks with absolute ticks, in the order of mido.merge_tracks but without copies"""
+    def abs_ticks(index: int, track: mido.MidiTrack) -> Iterator[Tuple[int, int, mido.Message]]:
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            yield tick, index, msg
+
+    for tick, index, msg in heapq.merge(*(abs_ticks(i, t) for i, t in enumerate(tracks)), key=lambda e: (e[0], e[1])):
+        yield tick, msg
+
+
+# Controller state: 16 x 128 controller values, 16 programs, 16 x 2 pitch bend bytes; 0xFF is unset
+_CTL_PROGRAM = 16 * 128
+_CTL_BEND = _CTL_PROGRAM + 16
+_CTL_SIZE = _CTL_BEND + 32
+_UNSET = 0xFF
+
+
+def _apply_controller(state: bytearray, data: bytes) -> None:
+    status, ch = data[0] & 0xF0, data[0] & 0x0F
+    if status == 0xB0 and data[1] < 120:  # Channel mode messages are not state
+        state[ch * 128 + data[1]] = data[2]
+    elif status == 0xC0:
+        state[_CTL_PROGRAM + ch] = data[1]
+    elif status == 0xE0:
+        state[_CTL_BEND + 2 * ch:_CTL_BEND + 2 * ch + 2] = data[1:3]
+
+
+class Timeline():
+    """MIDI file compiled to events sorted by absolute time with a beat / measure index
+
+    Beats are counted in quarter notes from the start of the file, the measure
+    wraps at the numerator of the current time signature.
+    """
+
+    CHECKPOINT = 256
+
+    def __init__(self, midifile: mido.MidiFile) -> None:
+        tpb = midifile.ticks_per_beat
+
+        self.times: list[float] = []
+        # Events pre-rendered to raw MIDI bytes
+        self.events: list[bytes] = []
+        # Controller state before every CHECKPOINT-th event
+        self._checkpoints: list[bytes] = []
+
+        self.beat_times: list[float] = [0.0]
+        self.beats: list[Tuple[int, int]] = [(1, 1)]
+        self._measures: dict[int, int] = {1: 0}  # Measure -> index of its first beat
+
+        # Tempo segment: tick and time of the last tempo change
+        tempo = 500000
+        seg_tick, seg_time = 0, 0.0
+        numerator = 4
+        measure, beat = 1, 1
+        next_beat = tpb
+
+        def tick2time(t: int) -> float:
+            return seg_time + (t - seg_tick) * tempo / tpb / 1_000_000
+
+        def count_beats(end: int) -> None:
+            nonlocal measure, beat, next_beat
+            while next_beat < end:
+                beat += 1
+                if beat > numerator:
+                    beat = 1
+                    measure += 1
+                    self._measures.setdefault(measure, len(self.beats))
+                self.beat_times.append(tick2time(next_beat))
+                self.beats.append((measure, beat))
+                next_beat += tpb
+
+        ctl = bytearray([_UNSET]) * _CTL_SIZE
+
+        tick = 0
+        for tick, msg in _merge_tracks(midifile.tracks):
+            # Beats at the event tick are counted after the event, with its tempo and time signature
+            count_beats(tick)
+
+            t = tick2time(tick)
+            if msg.is_meta:
+                if msg.type == 'set_tempo':
+                    seg_tick, seg_time = tick, t
+                    tempo = msg.tempo
+                elif msg.type == 'time_signature':
+                    numerator = msg.numerator
+            else:
+                data = bytes(msg.bytes())
+                if data[0] & 0xF0 == 0x90 and data[2] == 0:
+                    # Note on with zero velocity is note off
+                    data = bytes([0x80 | (data[0] & 0x0F), data[1], 0])
+                if len(self.events) % self.CHECKPOINT == 0:
+                    self._checkpoints.append(bytes(ctl))
+                _apply_controller(ctl, data)
+                self.times.append(t)
+                self.events.append(data)
+
+        count_beats(tick + 1)
+        self.length = tick2time(tick)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def event_index(self, timestamp: float) -> int:
+        """Index of the first event at or after the time"""
+        return bisect.bisect_left(self.times, timestamp)
+
+    def beat_index(self, timestamp: float) -> int:
+        """Index of the last beat at or before the time"""
+        return max(bisect.bisect_right(self.beat_times, timestamp) - 1, 0)
+
+    def measure_time(self, measure: int) -> Optional[float]:
+        index = self._measures.get(measure)
+        return None if index is None else self.beat_times[index]
+
+    def controller_state(self, index: int) -> list[bytes]:
+        """Messages restoring controllers, programs and pitch bend set by the events before `index`"""
+        cp = min(index // self.CHECKPOINT, len(self._checkpoints) - 1)
+        if cp < 0:
+            return []
+        state = bytearray(self._checkpoints[cp])
+        for data in self.events[cp * self.CHECKPOINT:index]:
+            _apply_controller(state, data)
+
+        ret = []
+        for ch in range(16):
+            ctl = state[ch * 128:(ch + 1) * 128]
+            # Bank select precedes the program change
+            for cc in (0, 32):
+                if ctl[cc] != _UNSET:
+                    ret.append(bytes([0xB0 | ch, cc, ctl[cc]]))
+            if state[_CTL_PROGRAM + ch] != _UNSET:
+                ret.append(bytes([0xC0 | ch, state[_CTL_PROGRAM + ch]]))
+            for cc, value in enumerate(ctl):
+                if value != _UNSET and cc not in (0, 32):
+                    ret.append(bytes([0xB0 | ch, cc, value]))
+            bend = state[_CTL_BEND + 2 * ch:_CTL_BEND + 2 * ch + 2]
+            if bend[0] != _UNSET:
+                ret.append(bytes([0xE0 | ch]) + bend)
+        return ret
@@ -1,30 +1,17 @@
 import time
 import mido
-import re
 import logging
-from typing import List, Optional, Tuple, Any
+from typing import List, Optional, Tuple, Any, NamedTuple
+from collections import deque
 
-from ..controller.base import BaseMidibox, Layer, PropHandler, General, Pedal, PropChange, Program, prg_id
+from ..controller.base import BaseMidibox, Layer, PropHandler, General, Pedal, PropChange, Program, RegisterImage, prg_id
+from ..controller.registers import Field, LAYER_LAYOUT, GENERAL_LAYOUT, get_diff_spans
 
-from threading import Thread
+from threading import Thread, Event, Lock
 
 
 READ_TIMEOUT = 1.0
-
-
-def get_first_diff_index(a: list[int], b: list[int], reverse: bool) -> Optional[int]:
-    r = reversed(range(len(a))) if reverse else range(len(a))
-    for i in r:
-        if a[i] != b[i]:
-            return i
-    return None
-
-
-def get_diff_range(a: list[int], b: list[int]) -> Optional[range]:
-    di_b, di_e = [get_first_diff_index(a, b, rev) for rev in [False, True]]
-    if di_b is None or di_e is None:
-        return None
-    return range(di_b, di_e)
+WRITE_TIMEOUT = 0.5
 
 
 def sbit(val: int, n: int, set: bool = True, numbits: int = 8) -> int:
@@ -38,11 +25,52 @@ class PortNotFoundError(Exception):
     pass
 
 
+class RetryPolicy(NamedTuple):
+    timeout: float = READ_TIMEOUT
+    retries: Optional[int] = None  # None: retry until response
+    backoff: float = 1.5  # Timeout multiplier for each retry
+    max_timeout: float = 4.0
+
+    def attempt_timeout(self, attempt: int) -> float:
+        return min(self.timeout * self.backoff ** attempt, self.max_timeout)
+
+
+READ_POLICY = RetryPolicy()
+WRITE_POLICY = RetryPolicy(timeout=WRITE_TIMEOUT, retries=2)
+
+TransactionKey = Tuple[int, int, int, int]
+
+
+class Transaction():
+    """Outstanding request to the device, keyed by (cmd, layer, offset, len)"""
+
+    def __init__(self, cmd: int, layer: int, offset: int, reqlen: int, msg: list[int] = [], policy: RetryPolicy = READ_POLICY) -> None:
+        self.key: TransactionKey = (cmd, layer, offset, reqlen)
+        self.msg = msg
+        self.policy = policy
+        self.event = Event()
+        self.data: Optional[list[int]] = None
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.deadline = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.event.is_set()
+
+    def complete(self, data: list[int]) -> None:
+        self.data = data
+        self.event.set()
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        self.event.set()
+
+
 class MidoMidibox(BaseMidibox):
     PERIODIC_CHECK = False
 
     _SYSEX_ID = 0x77
-    _LAYER_GENERAL = 15
 
     _CMD_INFO      = 0 # noqa
     _CMD_UPDATE    = 1 # noqa
@@ -52,23 +80,24 @@ class MidoMidibox(BaseMidibox):
     _CMD_WRITE_ACK = 5 # noqa
     _CMD_WRITE_NAK = 6 # noqa
 
-    _LR_GENERAL_OFFSETS = {
-        "pedal_cc": 6,
-        "pedal_mode": 14,
-        "pedal_min": 22,
-        "pedal_max": 30
-    }
+    _GENERAL_SIZE = GENERAL_LAYOUT.size
+    _LAYER_SIZE = LAYER_LAYOUT.size
+    _MAXREQ = 64
+    # Bytes of a request message besides the data: F0, ID, cmd/layer, offset, len, F7
+    _MSG_OVERHEAD = 6
 
-    _config: dict[int, List[int]]
+    _config: dict[int, bytearray]
     _do_init: dict[PropHandler, bool]
 
-    def __init__(self, port_name: str = "XIAO nRF52840", client_name: Optional[str] = None, virtual: bool = False, find: bool = True, debug: bool = False) -> None:
+    def __init__(self, port_name: str = "XIAO nRF52840", client_name: Optional[str] = None, virtual: bool = False, find: bool = True, debug: bool = False, read_policy: RetryPolicy = READ_POLICY, write_policy: RetryPolicy = WRITE_POLICY) -> None:
         self._log = logging.getLogger(__name__)
         self._port_name = port_name
         self._client_name = client_name
         self._virtual = virtual
         self._find = find
         self._debug = debug
+        self._read_policy = read_policy
+        self._write_policy = write_policy
 
         self.portout: Optional[mido.ports.BaseOutput] = None
         self.portin: Optional[mido.ports.BaseInput] = None
@@ -78,8 +107,12 @@ class MidoMidibox(BaseMidibox):
         self._do_init = {}
         self._config = {}
 
-        self._cb_data: Optional[list[int]] = None
-        self._cb_data_waiting: Optional[Tuple[int, int, int]] = None
+        # Outstanding transactions; several requests with the same key are answered in order
+        self._transactions: dict[TransactionKey, deque[Transaction]] = {}
+        # Expiry times of responses for retried or abandoned requests, which can still arrive late
+        self._stale: dict[Tuple[int, int, int], list[float]] = {}
+        self._tr_lock = Lock()
+        self._tr_wakeup = Event()
 
         self._midi_thread_exit = False
         self._midi_thread = Thread(target=self._connection_check)
@@ -104,38 +137,62 @@ class MidoMidibox(BaseMidibox):
             self._log.warning("write failed, portout is None: " + mido.format_as_string(msg, False))
 
     def set_props(self, props: list[PropChange]) -> None:
-        #done = []
-        origs: dict[int, list[int]] = {}
-        pprops: list[Optional[PropChange]] = [*props, None]
-        for p, np in zip(pprops, pprops[1:]):
-            if p is None:
-                # This not happend
+        origs: dict[int, bytearray] = {}
+        for p in props:
+            index = self._block_index(p.source)
+            if index is None:
                 continue
-            s = p.source if isinstance(p, PropChange) else None
-            ns = np.source if isinstance(np, PropChange) else None
+            if index not in origs:
+                origs[index] = self._config[index].copy()
 
+            s = p.source
             if isinstance(s, General):
-                index = self._LAYER_GENERAL
-                if index not in origs:
-                    origs[index] = self._config[index].copy()
                 self._update_general_config({p.name: p.value})
             elif isinstance(s, Layer):
-                index = s._index
-                if index not in origs:
-                    origs[index] = self._config[index].copy()
                 self._update_layer_config(s, [p.name])
             elif isinstance(s, Pedal):
-                index = s._layer._index
-                if index not in origs:
-                    origs[index] = self._config[index].copy()
                 self._update_pedal_config(s, [p.name])
 
-            if not self._same_layer(s, ns):
-                self._write_diff(index, self._config[index], origs[index])
-                del origs[index]
+        self._write_image(origs)
+
+    def snapshot(self) -> RegisterImage:
+        return {index: c.copy() for index, c in self._config.items()}
+
+    def apply_snapshot(self, image: RegisterImage, confirm: bool = True) -> bool:
+        # All blocks are checked before any of them is modified
+        for index, target in image.items():
+            c = self._config.get(index)
+            if c is None or len(c) != len(target):
+                raise ValueError(f"Invalid register block {index}")
 
-    def _layer_index(self, x: PropHandler | None) -> Optional[int]:
-        if isinstance(x, Layer):
+        origs: dict[int, bytearray] = {}
+        for index, target in image.items():
+            c = self._config[index]
+            origs[index] = c.copy()
+            c[:] = target
+
+        trs = self._write_image(origs)
+        with self.batch_events():
+            for index in origs:
+                grp = self._block_handler(index)
+                if grp is not None:
+                    self._load_config(grp)
+
+        if not confirm:
+            return True
+        return all([self._wait_transaction(tr) for tr in trs])
+
+    def _write_image(self, origs: dict[int, bytearray]) -> list[Transaction]:
+        # All changed blocks are written in one burst
+        trs = []
+        for index, orig in origs.items():
+            trs += self._write_diff(index, self._config[index], orig)
+        return trs
+
+    def _block_index(self, x: PropHandler | None) -> Optional[int]:
+        if isinstance(x, General):
+            index = self._LAYER_GENERAL
+        elif isinstance(x, Layer):
             index = x._index
         elif isinstance(x, Pedal):
             index = x._layer._index
@@ -143,10 +200,6 @@ class MidoMidibox(BaseMidibox):
             index = None
         return index
 
-    def _same_layer(self, a: PropHandler | None, b: PropHandler | None) -> bool:
-        i = tuple(self._layer_index(x) for x in (a, b))
-        return i[0] == i[1] and i[0] is not None
-
     def initialize(self) -> None:
         self._do_init[self.general] = True
         #self._write_general_config()
@@ -193,7 +246,9 @@ class MidoMidibox(BaseMidibox):
         checking = False
         self._midi_last_activity = time.time()
         while not self._midi_thread_exit:
-            time.sleep(0.2)
+            self._tr_wakeup.wait(min(0.2, max(self._next_deadline() - time.monotonic(), 0)))
+            self._tr_wakeup.clear()
+            self._expire_transactions()
             if not self.PERIODIC_CHECK:
                 self._midi_last_activity = time.time()
             if time.time() > self._midi_last_activity + 1:
@@ -232,15 +287,21 @@ class MidoMidibox(BaseMidibox):
         if not self._rc_callback(msg):
             self.input_callback(msg)
 
-    def _init_config(self, retries: Optional[int] = None, timeout: float = READ_TIMEOUT) -> None:
-        self._read_general_config(retries, timeout)
+    def _init_config(self, retries: Optional[int] = None, timeout: Optional[float] = None) -> None:
+        policy = self._get_read_policy(retries, timeout)
 
-        for lr in self.layers:
-            self._read_layer_config(lr, retries, timeout)
+        # Issue all block reads at once, the responses are collected afterwards
+        blocks = {self._LAYER_GENERAL: self._GENERAL_SIZE}
+        blocks.update({lr._index: self._LAYER_SIZE for lr in self.layers})
+        reqs = {index: self._submit_read(index, 0, size, policy) for index, size in blocks.items()}
 
-        c = self._config.get(self._LAYER_GENERAL)
-        if c is None:
-            return
+        for index, r in reqs.items():
+            self._config[index] = bytearray(self._wait_for_reads(r))
+
+        with self.batch_events():
+            self._load_general_config()
+            for lr in self.layers:
+                self._load_layer_config(lr)
 
         p = [
             PropChange(self.general, "_check-keep-alive", self.PERIODIC_CHECK),
@@ -255,75 +316,186 @@ class MidoMidibox(BaseMidibox):
             assert reqlen == len(msg)
         self.send([0xF0, self._SYSEX_ID, c, offset, reqlen] + msg + [0xF7])
 
-    def _wait_for_cb_data(self, timeout: float = READ_TIMEOUT) -> Optional[list[int]]:
-        while not self._cb_data and timeout > 0:
-            time.sleep(0.01)
-            timeout -= 0.01
-        ret = self._cb_data
-        #assert ret is not None
-        if not ret:
-            self._log.error("Error: no data received")
-        self._cb_data = None
+    def _send_transaction(self, tr: Transaction) -> None:
+        with self._tr_lock:
+            if tr.attempts == 0:
+                self._transactions.setdefault(tr.key, deque()).append(tr)
+            tr.deadline = time.monotonic() + tr.policy.attempt_timeout(tr.attempts)
+            tr.attempts += 1
+        self._tr_wakeup.set()
+        self._send_mbreq(*tr.key, tr.msg)
+
+    def _submit_read(self, lr_index: int, firstreg: int, lastreg: int, policy: Optional[RetryPolicy] = None) -> list[Transaction]:
+        reqs = []
+        while lastreg > firstreg:
+            reqlen = min(lastreg - firstreg, self._MAXREQ)
+            key = (self._CMD_READ_REQ, lr_index, firstreg, reqlen)
+            with self._tr_lock:
+                # Join the identical read which is already on the way
+                pending = self._transactions.get(key)
+                tr = pending[-1] if pending else None
+            if tr is None:
+                tr = Transaction(*key, policy=policy or self._read_policy)
+                self._send_transaction(tr)
+            reqs.append(tr)
+            firstreg += reqlen
+        return reqs
 
-        return ret
+    def _submit_write(self, lr_index: int, offset: int, msg: list[int]) -> Transaction:
+        tr = Transaction(self._CMD_WRITE_REQ, lr_index, offset, len(msg), msg, self._write_policy)
+        self._send_transaction(tr)
+        return tr
 
-    def _read_regs(self, lr_index: int, firstreg: int, lastreg: int, retries: Optional[int] = None, timeout: float = READ_TIMEOUT) -> List[int]:
+    def _wait_transaction(self, tr: Transaction) -> bool:
+        while not tr.event.wait(max(tr.deadline - time.monotonic(), 0)):
+            self._expire_transactions()
+        return tr.error is None
+
+    def _wait_for_reads(self, reqs: list[Transaction]) -> List[int]:
         ret: List[int] = []
-        MAXREQ = 64
-        while lastreg > firstreg:
-            reqlen = min(lastreg - firstreg, MAXREQ)
-
-            c = None
-            burst_retries = retries
-            while c is None:
-                self._cb_data = None
-                self._cb_data_waiting = (lr_index, firstreg, reqlen)
-                self._send_mbreq(self._CMD_READ_REQ, lr_index, firstreg, reqlen)
-                c = self._wait_for_cb_data(timeout)
-                if c is None:
-                    if burst_retries is not None and burst_retries == 0:
-                        raise ConnectionError("No response for read request")
-                    elif burst_retries is not None and burst_retries > 0:
-                        burst_retries -= 1
-                    print("Retrying read reg")
-
-            ret += c
-            firstreg += reqlen
+        for tr in reqs:
+            if not self._wait_transaction(tr):
+                raise ConnectionError("No response for read request")
+            assert tr.data is not None
+            ret += tr.data
         return ret
 
+    def _get_read_policy(self, retries: Optional[int] = None, timeout: Optional[float] = None) -> RetryPolicy:
+        policy = self._read_policy
+        if retries is not None:
+            policy = policy._replace(retries=retries)
+        if timeout is not None:
+            policy = policy._replace(timeout=timeout)
+        return policy
+
+    def _read_regs(self, lr_index: int, firstreg: int, lastreg: int, retries: Optional[int] = None, timeout: Optional[float] = None) -> List[int]:
+        policy = self._get_read_policy(retries, timeout)
+        return self._wait_for_reads(self._submit_read(lr_index, firstreg, lastreg, policy))
+
+    def _next_deadline(self) -> float:
+        with self._tr_lock:
+            return min((tr.deadline for q in self._transactions.values() for tr in q), default=float('inf'))
+
+    def _add_stale(self, tr: Transaction, count: int) -> None:
+        if count > 0:
+            expire = time.monotonic() + tr.policy.max_timeout
+            self._stale.setdefault(tr.key[1:], []).extend([expire] * count)
+
+    def _pop_stale(self, key: Tuple[int, int, int]) -> bool:
+        stale = self._stale.get(key)
+        if stale is None:
+            return False
+        now = time.monotonic()
+        stale[:] = [t for t in stale if t > now]
+        if stale:
+            stale.pop(0)
+        if not stale:
+            del self._stale[key]
+        return True
+
+    def _expire_transactions(self) -> None:
+        now = time.monotonic()
+        resend, failed = [], []
+        with self._tr_lock:
+            for key, q in list(self._transactions.items()):
+                for tr in list(q):
+                    if tr.deadline > now:
+                        continue
+                    if tr.policy.retries is not None and tr.attempts > tr.policy.retries:
+                        q.remove(tr)
+                        self._add_stale(tr, tr.attempts)
+                        failed.append(tr)
+                    else:
+                        resend.append(tr)
+                if not q:
+                    del self._transactions[key]
+
+        for tr in failed:
+            self._log.error(f"No response for request {tr.key}")
+            tr.fail("timeout")
+        for tr in resend:
+            self._log.info(f"Retrying request {tr.key}")
+            if tr.key[0] == self._CMD_WRITE_REQ:
+                # A newer write to the span can be acknowledged already, resend the current values
+                _, layer, offset, reqlen = tr.key
+                tr.msg = list(self._config[layer][offset:offset + reqlen])
+            self._send_transaction(tr)
+
+    def _complete_transaction(self, key: TransactionKey) -> Optional[Transaction]:
+        with self._tr_lock:
+            q = self._transactions.get(key)
+            if not q:
+                return None
+            tr = q.popleft()
+            if not q:
+                del self._transactions[key]
+            self._add_stale(tr, tr.attempts - 1)
+            return tr
+
     def _rc_callback(self, msg: mido.Message) -> bool:
         if msg.type == 'sysex' and len(msg.data) > 2 and msg.data[0] == self._SYSEX_ID:
             cmd = (msg.data[1] >> 4) & 0x07
             layer = msg.data[1] & 0x0F
             offset = msg.data[2]
             reqlen = msg.data[3]
-            # FIXME: only READ_RES
             data = list(msg.data[4:])
 
+            if cmd == self._CMD_WRITE_NAK:
+                tr = self._complete_transaction((self._CMD_WRITE_REQ, layer, offset, reqlen))
+                if tr is not None:
+                    tr.fail("nak")
+                self._log.warning(f"Write request rejected: {(layer, offset, reqlen)}")
+                # Resynchronize local copy of the registers, see unrequested update
+                self._send_mbreq(self._CMD_READ_REQ, layer, offset, reqlen)
+                return True
+
             if reqlen != len(msg.data) - 4:
                 self._log.error("Request length != data length")
                 return True
 
-            if self._cb_data_waiting == (layer, offset, reqlen):
-                self._cb_data = data
-                self._cb_data_waiting = None
-            else:
-                # Unrequested update
-                if cmd == self._CMD_READ_RES:
-                    grp: Optional[PropHandler] = None
-
-                    if layer < 8:
-                        grp = self.layers[layer]
-                    elif layer == self._LAYER_GENERAL:
-                        grp = self.general
-
-                    if grp is not None:
-                        cfg = self._config[layer]
-                        cfg[offset:offset + reqlen] = data
-                        self._load_config(grp)
+            if cmd == self._CMD_WRITE_ACK:
+                tr = self._complete_transaction((self._CMD_WRITE_REQ, layer, offset, reqlen))
+                if tr is None:
+                    return True
+                tr.complete(data)
+                # INFO: WRITE_ACK can contain clamped values
+                if data != tr.msg and not self._write_pending(layer):
+                    self._update_config(layer, offset, data)
+            elif cmd == self._CMD_READ_RES:
+                tr = self._complete_transaction((self._CMD_READ_REQ, layer, offset, reqlen))
+                if tr is not None:
+                    tr.complete(data)
+                else:
+                    with self._tr_lock:
+                        stale = self._pop_stale((layer, offset, reqlen))
+                    if not stale:
+                        # Unrequested update
+                        self._update_config(layer, offset, data)
+            elif cmd == self._CMD_UPDATE:
+                self._update_config(layer, offset, data)
             return True
         return False
 
+    def _write_pending(self, layer: int) -> bool:
+        with self._tr_lock:
+            return any(key[0] == self._CMD_WRITE_REQ and key[1] == layer for key in self._transactions)
+
+    def _update_config(self, layer: int, offset: int, data: list[int]) -> None:
+        grp = self._block_handler(layer)
+        cfg = self._config.get(layer)
+        if grp is None or cfg is None:
+            return
+
+        # Only the fields with modified bytes are decoded and emitted
+        layout = self._block_layout(layer)
+        fields = layout.changed(cfg, data, offset)
+        cfg[offset:offset + len(data)] = bytes(data)
+        if fields:
+            self._load_fields(layer, fields)
+
+    def _load_fields(self, layer: int, fields: Optional[list[Field]] = None) -> None:
+        self.load_block(layer, self._config[layer], fields)
+
     def _load_config(self, source: PropHandler) -> None:
         if isinstance(source, General):
             self._load_general_config()
@@ -340,8 +512,6 @@ class MidoMidibox(BaseMidibox):
 
     def _update_general_config(self, names: dict[str, Any]) -> None:
         c = self._config[self._LAYER_GENERAL]
-        if "enable" in names:
-            c[0] = sbit(c[0], 0, self.general.enable)
 
         if "_check-keep-alive" in names:
             c[0] = sbit(c[0], 6, names["_check-keep-alive"])
@@ -349,30 +519,23 @@ class MidoMidibox(BaseMidibox):
         if "_send-adc-rawdata" in names:
             c[0] = sbit(c[0], 5, names["_send-adc-rawdata"])
 
-        for i in range(8):
-            for n, o in self._LR_GENERAL_OFFSETS.items():
-                name = f"{n}{i}"
-                if name in names:
-                    c[o+i] = getattr(self.general, name)
+        for name in names:
+            f = GENERAL_LAYOUT.field(name)
+            if f is not None:
+                f.encode(c, getattr(self.general, name))
 
         #####c[2] = 1 if self._do_init.get(self.general, 1) else 0
         #c[3] = self._selected_layer
         self._do_init[self.general] = False
         #c[4:6] = [120, 0] # tempo
 
-    def _read_general_config(self, retries: Optional[int] = None, timeout: float = READ_TIMEOUT) -> None:
-        c = self._read_regs(self._LAYER_GENERAL, 0, 6 + 16 + 16, retries, timeout)
-        self._config[self._LAYER_GENERAL] = c
+    def _read_general_config(self, retries: Optional[int] = None, timeout: Optional[float] = None) -> None:
+        c = self._read_regs(self._LAYER_GENERAL, 0, self._GENERAL_SIZE, retries, timeout)
+        self._config[self._LAYER_GENERAL] = bytearray(c)
         self._load_general_config()
 
     def _load_general_config(self) -> None:
-        c = self._config[self._LAYER_GENERAL]
-        self.general.enable = True if c[0] & 1 else False
-
-        for i in range(8):
-            for n, o in self._LR_GENERAL_OFFSETS.items():
-                name = f"{n}{i}"
-                setattr(self.general, name, c[o+i])
+        self._load_fields(self._LAYER_GENERAL)
 
     def _write_layer_config(self, layer: Layer) -> None:
         c = self._config.get(layer)
@@ -386,99 +549,32 @@ class MidoMidibox(BaseMidibox):
 
     def _update_layer_config(self, lr: Layer, names: list[str]) -> None:
         c = self._config[lr._index]
-        # FIXME: general
-
-        if "enabled" in names:
-            c[0] = sbit(c[0], 0, lr.enabled)
-        if "active" in names:
-            c[0] = sbit(c[0], 1, lr.active)
 
         #c[2] = 1 if self._do_init.get(lr, 1) else 0
         #self._do_init[lr] = False
 
-        if "rangel" in names:
-            c[6] = lr.rangel
-        if "rangeu" in names:
-            c[7] = lr.rangeu
-        if "volume" in names:
-            c[8] = lr.volume
-        if "transposition" in names:
-            c[10] = lr.transposition + 64
-        if "transposition_extra" in names:
-            c[11] = lr.transposition_extra + 64
-        if "release" in names:
-            c[12] = lr.release + 64
-        if "attack" in names:
-            c[13] = lr.attack + 64
-        if "cutoff" in names:
-            c[14] = lr.cutoff + 64
-        if "decay" in names:
-            c[15] = lr.decay + 64
-
-        if "program" in names:
-            p = None
-            m = re.fullmatch(r"_pgm_(\d+)_(\d+)_(\d+)_", lr.program)
-            if m is not None:
-                g = m.groups()
-                pc, msb, lsb = int(g[0]), int(g[1]), int(g[2])
-                c[3:6] = [pc - 1, msb, lsb]
-        if "percussion" in names:
-            c[32] = lr.percussion
-        for i in range(9):
-            n = f'harmonic_bar{i}'
-            if n in names:
-                c[33 + i] = getattr(lr, n)
-        if "portamento_time" in names:
-            c[42] = lr._portamento_time
-
-        if "volume_ch" in names:
-            c[43] = lr._volume_ch
+        for name in names:
+            f = LAYER_LAYOUT.field(name)
+            if f is not None:
+                f.encode(c, getattr(lr, name))
 
     def _update_pedal_config(self, p: Pedal, names: list[str]) -> None:
-        lr = p._layer
-        i = p._index
-        c = self._config[lr._index]
+        c = self._config[p._layer._index]
 
-        if "cc" in names:
-            c[16 + i] = p.cc
-        if "mode" in names:
-            c[24 + i] = p.mode # Disable pedal temporarily
+        for name in names:
+            f = LAYER_LAYOUT.field(name, p._index)
+            if f is not None:
+                f.encode(c, getattr(p, name))
 
-    def _write_diff(self, id: int, c: list[int], orig_c: list[int]) -> None:
-        r = get_diff_range(c, orig_c)
-        if r is not None:
-            self._send_mbreq(self._CMD_WRITE_REQ, id, r.start, len(r) + 1, c[r.start:r.stop + 1])
+    def _write_diff(self, id: int, c: bytearray, orig_c: bytearray) -> list[Transaction]:
+        # Split to more requests only when the unchanged gap costs more than the message overhead
+        spans = get_diff_spans(c, orig_c, self._MSG_OVERHEAD)
+        return [self._submit_write(id, r.start, list(c[r.start:r.stop])) for r in spans]
 
-    def _read_layer_config(self, layer: Layer, retries: Optional[int] = None, timeout: float = READ_TIMEOUT) -> None:
+    def _read_layer_config(self, layer: Layer, retries: Optional[int] = None, timeout: Optional[float] = None) -> None:
         lr = layer
-        self._config[lr._index] = self._read_regs(lr._index, 0, 44, retries, timeout)
+        self._config[lr._index] = bytearray(self._read_regs(lr._index, 0, self._LAYER_SIZE, retries, timeout))
         self._load_layer_config(lr)
 
     def _load_layer_config(self, layer: Layer) -> None:
-        lr = layer
-        c = self._config[lr._index]
-        lr.enabled = True if c[0] & 1 else False
-        lr.active = True if c[0] & 2 else False
-        lr.rangel, lr.rangeu, lr.volume = c[6], c[7], c[8]
-        lr.transposition = c[10] - 64
-        lr.transposition_extra = c[11] - 64
-        lr.release = c[12] - 64
-        lr.attack = c[13] - 64
-        lr.cutoff = c[14] - 64
-        lr.decay = c[15] - 64
-
-        pc, bs, bs_lsb = c[3:6]
-        pc += 1
-        program = f"_pgm_{pc}_{bs}_{bs_lsb}_"
-        lr.program = program
-
-        for i in range(len(lr.pedals)):
-            lr.pedals[i].cc = c[16 + i]
-            lr.pedals[i].mode = c[24 + i]
-
-        lr.percussion = c[32]
-        for i in range(9):
-            setattr(lr, f'harmonic_bar{i}', c[33 + i])
-
-        lr.portamento_time = c[42]
-        lr.volume_ch = c[43]
+        self._load_fields(layer._index)
@@ -1,11 +1,11 @@
 import socket
 import urllib.parse
 import time
-import re
 import threading
+import struct
 import mido
 
-from typing import Tuple, Optional
+from typing import Any, Tuple, Optional, Sequence
 
 from pythonosc.osc_packet import OscPacket, TimedMessage
 from pythonosc.osc_message import OscMessage
@@ -13,8 +13,9 @@ from pythonosc.osc_bundle import OscBundle
 from pythonosc.osc_message_builder import OscMessageBuilder
 from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
 
-from .osc import OscValue
-from ..controller.base import BaseMidibox, PropChange, General, Layer, Pedal
+from .osc import OscValue, FrameBuffer, decode_message, parse_multicast, NO_EPOCH
+from ..controller.base import BaseMidibox, RegisterImage, PropChange, PropHandler, General, Layer, Pedal, GeneralProps, LayerProps, PedalProps
+from ..controller.registers import serialize_image, parse_image
 
 
 class OscClient(threading.Thread):
@@ -23,6 +24,7 @@ class OscClient(threading.Thread):
         self.addr = addr
         self.gp = gp
         self.s: Optional[socket.socket] = None
+        self._rbuf = FrameBuffer()
 
     def start(self) -> None:
         self.alive = threading.Event()
@@ -31,10 +33,11 @@ class OscClient(threading.Thread):
 
     def stop(self) -> None:
         self.alive.clear()
-        if self.s:
+        s = self.s
+        if s:
             try:
-                self.s.shutdown(socket.SHUT_RDWR)
-                self.s.close()
+                s.shutdown(socket.SHUT_RDWR)
+                s.close()
             except OSError:
                 pass
         self.join()
@@ -42,6 +45,9 @@ class OscClient(threading.Thread):
     def handle_msg(self, m: TimedMessage) -> None:
         self.gp.handle_msg(m)
 
+    def handle_packet(self, packet: OscPacket) -> None:
+        self.gp.handle_packet(packet)
+
     def send_message(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
         builder = OscMessageBuilder(address=address)
 
@@ -55,18 +61,6 @@ class OscClient(threading.Thread):
             raise ConnectionError
         self.s.sendall(msg.size.to_bytes(length=4, byteorder='big') + msg.dgram)
 
-    def _recv(self, size: int) -> bytes:
-        recv = bytes()
-        while len(recv) != size:
-            if self.s is None:
-                raise ConnectionError
-            b = self.s.recv(size - len(recv))
-            if not b:
-                raise ConnectionError
-            recv += b
-
-        return recv
-
     def connect(self) -> None:
         self.s = None
         while self.s is None and self.alive.is_set():
@@ -78,28 +72,84 @@ class OscClient(threading.Thread):
                 except TimeoutError:
                     continue
                 s.settimeout(None)
+                self._rbuf = FrameBuffer()
                 self.s = s
             except OSError:
                 time.sleep(0.1)
         if self.s:
             print("OSC client connected")
+            try:
+                self.gp.handle_connect()
+            except OSError:
+                pass  # Connection is checked by the receive loop
 
     def run(self) -> None:
         self.connect()
         while self.alive.is_set():
             try:
-                data = self._recv(4)
-                size = int.from_bytes(data, byteorder='big')
-                data = self._recv(size)
+                if self.s is None or self._rbuf.recv_into(self.s) == 0:
+                    raise ConnectionError
 
-                for m in OscPacket(data).messages:
-                    self.handle_msg(m)
-            except ConnectionError:
+                for frame in self._rbuf.frames():
+                    msg = decode_message(frame)
+                    if msg is not None:
+                        self.gp.handle_message(*msg)
+                    else:
+                        self.handle_packet(OscPacket(bytes(frame)))
+            except OSError:
                 self.connect()
 
 
+class OscUDPReceiver(threading.Thread):
+    """Receiver of the latency sensitive streams sent by UDP, optionally from a multicast group"""
+    def __init__(self, gp: "OscMidibox", multicast: Optional[Tuple[str, int]] = None):
+        threading.Thread.__init__(self)
+        self.gp = gp
+        self.multicast = multicast
+
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if multicast is not None:
+            group, port = multicast
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.s.bind(('', port))
+            mreq = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+            self.s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        else:
+            self.s.bind(('', 0))
+        self.s.settimeout(0.5)
+        self.port: int = self.s.getsockname()[1]
+
+    def start(self) -> None:
+        self.alive = threading.Event()
+        self.alive.set()
+        threading.Thread.start(self)
+
+    def stop(self) -> None:
+        self.alive.clear()
+        self.join()
+        self.s.close()
+
+    def run(self) -> None:
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        while self.alive.is_set():
+            try:
+                n = self.s.recv_into(buf)
+            except TimeoutError:
+                continue
+            except OSError:
+                break
+
+            frame = view[:n]
+            msg = decode_message(frame)
+            if msg is not None:
+                self.gp.handle_message(*msg)
+            else:
+                self.gp.handle_packet(OscPacket(bytes(frame)))
+
+
 class OscMidibox(BaseMidibox):
-    def __init__(self, url: Optional[str] = None, addr: str = "localhost", port: int = 4302, debug: bool = False) -> None:
+    def __init__(self, url: Optional[str] = None, addr: str = "localhost", port: int = 4302, debug: bool = False, udp: bool = False, multicast: Optional[str] = None) -> None:
         super().__init__()
 
         if url is not None:
@@ -114,62 +164,92 @@ class OscMidibox(BaseMidibox):
         print(f"Using OSC MidiBox client: {connection}")
         self.client = OscClient(self, connection)
 
-        self._pedal_regex = r"pedal(\d+)\.(\w+)"
+        # MIDI echo and player position by UDP; multicast is `group[:port]`, port defaults to the server port
+        self.udp: Optional[OscUDPReceiver] = None
+        self._multicast: Optional[Tuple[str, int]] = None
+        if multicast is not None:
+            self._multicast = parse_multicast(multicast, connection[1])
+        if udp or multicast is not None:
+            self.udp = OscUDPReceiver(self, self._multicast)
+
+        # Last known server state revision, used for delta sync after reconnect
+        self._server_epoch: Optional[int] = None
+        self._server_revision = 0
+        # Register image of the last /midibox/state, keeps the bytes not covered by properties
+        self._image: RegisterImage = {}
+
+        # Precompiled address -> (handler object, property) routing table
+        self._routes: dict[str, Tuple[PropHandler, str]] = {}
+        for mbp in GeneralProps:
+            self._routes[f"/midibox/{mbp.name}"] = (self.general, mbp.name)
+        for lr in self.layers:
+            for mblp in LayerProps:
+                self._routes[f"/midibox/layers/{lr._index}/{mblp.name}"] = (lr, mblp.name)
+            for pedal in lr.pedals:
+                for mbpp in PedalProps:
+                    self._routes[f"/midibox/layers/{lr._index}/pedal{pedal._index}.{mbpp.name}"] = (pedal, mbpp.name)
 
     def connect(self) -> None:
+        if self.udp is not None:
+            self.udp.start()
         self.client.start()
 
     def disconnect(self) -> None:
         self.client.stop()
-
-    def handle_msg(self, m: TimedMessage) -> None:
-        addrs, params = m.message.address, m.message.params
-        addr = addrs.split("/")
-
-        if len(addr) < 2 or addr[1] != "midibox":
+        if self.udp is not None:
+            self.udp.stop()
+
+    def handle_connect(self) -> None:
+        # Versioned /init requests the delta or the register image instead of all properties
+        epoch = NO_EPOCH if self._server_epoch is None else self._server_epoch
+        self.client.send_message("/init", epoch, self._server_revision)
+
+        if self._multicast is not None:
+            self.client.send_message("/udp/subscribe", self._multicast[1], self._multicast[0])
+        elif self.udp is not None:
+            self.client.send_message("/udp/subscribe", self.udp.port)
+
+    def handle_packet(self, packet: OscPacket) -> None:
+        """Apply all messages of the packet, the control_change is emitted once per handler"""
+        messages = packet.messages
+        if len(messages) == 1:
+            self.handle_msg(messages[0])
             return
 
-        addr = addr[2:]
+        values: dict[PropHandler, dict[str, Any]] = {}
+        with self.batch_events():
+            for m in messages:
+                route = self._routes.get(m.message.address)
+                if route is None:
+                    self.handle_msg(m)
+                elif m.message.params:
+                    ph, prop = route
+                    values.setdefault(ph, {})[prop] = m.message.params[0]
+            for ph, props in values.items():
+                ph.load_props(props)
 
-        if addr == ["midi"]:
-            lmsg = list(params[0])
-            msg = mido.Message.from_bytes(lmsg)
+    def handle_msg(self, m: TimedMessage) -> None:
+        self.handle_message(m.message.address, m.message.params)
+
+    def handle_message(self, address: str, params: Sequence[OscValue]) -> None:
+        route = self._routes.get(address)
+        if route is not None:
+            if params:
+                ph, prop = route
+                ph.load_props({prop: params[0]})
+        elif address == "/midibox/revision":
+            epoch, revision = int(params[0]), int(params[1])
+            if epoch != self._server_epoch:
+                self._server_epoch, self._server_revision = epoch, revision
+            else:
+                self._server_revision = max(self._server_revision, revision)
+        elif address == "/midibox/state":
+            self._image = parse_image(params[0])  # type: ignore[arg-type]
+            self._load_image(self._image)
+        elif address == "/midibox/midi":
+            msg = mido.Message.from_bytes(list(params[0]))  # type: ignore[arg-type]
             for cb in self._callbacks:
                 cb(msg)
-            return
-
-        if len(addr) >= 1:
-            prop = addr[0]
-            addr = addr[1:]
-            if len(addr) == 0:
-                if hasattr(self.general, f"_{prop}"):
-                    setattr(self.general, f"_{prop}", params[0])
-                    kwargs = {prop: getattr(self.general, prop)}
-                    self.general.emit('control_change', **kwargs)
-            elif prop == "layers" and len(addr) >= 2:
-                lr = self.layers[int(addr[0])]
-                prop = addr[1]
-                addr = addr[2:]
-                if len(addr) == 0:
-                    if hasattr(lr, f"_{prop}"):
-                        setattr(lr, f"_{prop}", params[0])
-                        kwargs = {prop: getattr(lr, prop)}
-                        lr.emit('control_change', **kwargs)
-                    else:
-                        match_res = re.fullmatch(self._pedal_regex, prop)
-                        if match_res is None:
-                            grps = None
-                        else:
-                            grps = match_res.groups()
-
-                        if grps is not None:
-                            index = int(grps[0])
-                            prop = grps[1]
-                            pedal = lr.pedals[index]
-                            if hasattr(pedal, prop):
-                                kwargs = {prop: getattr(pedal, prop)}
-                                setattr(pedal, f"_{prop}", params[0])
-                                pedal.emit('control_change', **kwargs)
 
     def initialize(self) -> None:
         self.client.send_message("/midibox/initialize")
@@ -192,5 +272,23 @@ class OscMidibox(BaseMidibox):
         msg = bundle.build()
         self.client.send_msg(msg)
 
+    def _load_image(self, image: RegisterImage) -> None:
+        with self.batch_events():
+            for layer, c in image.items():
+                if self._block_handler(layer) is not None and len(c) == self._block_layout(layer).size:
+                    self.load_block(layer, c)
+
+    def snapshot(self) -> RegisterImage:
+        return self.encode_image(self._image)
+
+    def apply_snapshot(self, image: RegisterImage, confirm: bool = True) -> bool:
+        """Send the image to the server; writes to the device are not confirmed over OSC"""
+        for layer, c in image.items():
+            if self._block_handler(layer) is None or len(c) != self._block_layout(layer).size:
+                raise ValueError(f"Invalid register block {layer}")
+        self.client.send_message("/midibox/state", serialize_image(image))
+        self._load_image(image)
+        return True
+
     def sendmsg(self, msg: mido.Message) -> None:
         self.client.send_message("/midibox/midi", bytes(msg.bytes()))
@@ -1,33 +1,98 @@
-import mido
-from typing import Callable, Any
+import threading
+import weakref
 
-from ..controller.base import BaseMidibox, Layer, Pedal, GeneralProps, LayerProps, PedalProps, PropHandler
-from .server import DispatchedOSCRequestHandler
+import mido
+from typing import Any, Iterable, Optional, Tuple
 
 from pythonosc.osc_message_builder import OscMessageBuilder
-from pythonosc.osc_bundle_builder import OscBundleBuilder as OriginalOscBundleBuilder, IMMEDIATELY
-
-
-class OscBundleBuilder(OriginalOscBundleBuilder):
-    def __init__(self) -> None:
-        super().__init__(IMMEDIATELY)
 
-    def add_msg(self, address: str, value: Any) -> None:
-        values = [value]
-        builder = OscMessageBuilder(address=address)
-        for val in values:
-            builder.add_arg(val)
-        self.add_content(builder.build())  # type: ignore
+from ..controller.base import BaseMidibox, GeneralProps, LayerProps, PedalProps, PropHandler
+from ..controller.registers import serialize_image, parse_image
+from .osc import OscValue
+from .server import DispatchedOSCRequestHandler, DispatcherMaps
 
 
 class ControlChangeHandlerProxy():
-    def __init__(self, p: PropHandler, handler: Callable[..., None]) -> None:
-        self._p = p
-        self._handler = handler
-        p.bind(control_change=self.on_control_change)
+    """Forwards control_change of one PropHandler to all clients of the fan-out"""
+    def __init__(self, fanout: "MidiboxOSCFanout", p: PropHandler, address: str, props: Iterable[Any]) -> None:
+        self._fanout = fanout
+        self.p = p
+        self._address = address
+        self.addresses = {prop.name: address % (prop.name) for prop in props}
+
+    def bind(self) -> None:
+        self.p.bind(control_change=self.on_control_change)
+
+    def unbind(self) -> None:
+        self.p.unbind(self.on_control_change)
+
+    def on_control_change(self, **kwargs: Any) -> None:
+        items = [(self.addresses.get(prop) or self._address % (prop), value) for prop, value in kwargs.items()]
+        revision = (self.p._dev.epoch, self.p.revision_of(kwargs))
+        for c in self._fanout.clients:
+            for address, value in items:
+                c.send_state(address, value)
+            c.send_state("/midibox/revision", *revision)
+
+
+class MidiboxOSCFanout():
+    """Single subscriber of Midibox events for all connected clients
+
+    Midibox events are bound only while at least one client is connected.
+    """
+    _instances: "weakref.WeakKeyDictionary[BaseMidibox, MidiboxOSCFanout]" = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, mb: BaseMidibox) -> "MidiboxOSCFanout":
+        with cls._instances_lock:
+            fanout = cls._instances.get(mb)
+            if fanout is None:
+                fanout = cls._instances[mb] = cls(mb)
+            return fanout
+
+    def __init__(self, mb: BaseMidibox) -> None:
+        self.mb = mb
+        self.clients: Tuple["MidiboxOSCClientHandler", ...] = ()
+        self._lock = threading.Lock()
+
+        self.proxies = [ControlChangeHandlerProxy(self, mb.general, "/midibox/%s", GeneralProps)]
+        for lr in mb.layers:
+            self.proxies.append(ControlChangeHandlerProxy(self, lr, "/midibox/layers/%d/%%s" % (lr._index), LayerProps))
+            for pedal in lr.pedals:
+                self.proxies.append(ControlChangeHandlerProxy(self, pedal, "/midibox/layers/%d/pedal%d.%%s" % (lr._index, pedal._index), PedalProps))
+
+        # Properties not transferred in the register image of /midibox/state
+        self.unregistered = [(proxy, prop) for proxy in self.proxies for prop in proxy.addresses if mb.register_field(proxy.p, prop) is None]
+
+    def add(self, client: "MidiboxOSCClientHandler") -> None:
+        with self._lock:
+            if not self.clients:
+                for proxy in self.proxies:
+                    proxy.bind()
+                self.mb._callbacks.append(self.mb_midi_callback)
+            self.clients += (client,)
+
+    def remove(self, client: "MidiboxOSCClientHandler") -> None:
+        with self._lock:
+            if client not in self.clients:
+                return
+            self.clients = tuple(c for c in self.clients if c is not client)
+            if not self.clients:
+                for proxy in self.proxies:
+                    proxy.unbind()
+                self.mb._callbacks.remove(self.mb_midi_callback)
+
+    def mb_midi_callback(self, msg: mido.Message) -> None:
+        if msg.type == 'clock':
+            return
 
-    def on_control_change(self, *args: Any, **kwargs: Any) -> None:
-        self._handler(self._p, *args, **kwargs)
+        builder = OscMessageBuilder(address="/midibox/midi")
+        builder.add_arg(bytes(msg.bytes()))
+        osc_msg = builder.build()
+        clients = self.clients
+        if clients:
+            clients[0].server.send_datagram(osc_msg, clients)
 
 
 class MidiboxOSCClientHandler(DispatchedOSCRequestHandler):
@@ -35,90 +100,101 @@ class MidiboxOSCClientHandler(DispatchedOSCRequestHandler):
 
     def setup(self) -> None:
         super().setup()
-        self.mb._callbacks.append(self.mb_midi_callback)
+        self._fanout = MidiboxOSCFanout.get(self.mb)
+        self._fanout.add(self)
 
-        self.__init_dispatcher()
-        self.__init()
+        # No state is sent before the first message, it tells whether the client uses /init
+        self._initialized = False
 
-    def __init_dispatcher(self) -> None:
-        self.map("/init", self.__init)
+    @classmethod
+    def init_shared_dispatcher(cls, maps: DispatcherMaps) -> None:
+        super().init_shared_dispatcher(maps)
+        maps["/init"] = (cls.__init, ())
 
         # Midibox section
-        self.mb.general.bind(control_change=self.on_main_control_change)
         for mbp in GeneralProps:
-            self.map("/midibox/%s" % (mbp.name), self.main_control_change, mbp.name)
-
-        self.map("/midibox/initialize", self.initialize)
-        self.map("/midibox/midi", self.on_midi)
-
-        self._chp = []
-
-        for lr in self.mb.layers:
-            for mblp in LayerProps:
-                self.map("/midibox/layers/%d/%s" % (lr._index, mblp.name), self.layer_control_change, lr, mblp.name)
-            self._chp.append(ControlChangeHandlerProxy(lr, self.on_layer_control_change))
-            for pedal in lr.pedals:
-                for mbpp in PedalProps:
-                    self.map("/midibox/layers/%d/pedal%d.%s" % (lr._index, pedal._index, mbpp.name), self.layer_pedal_control_change, pedal, mbpp.name)
-                self._chp.append(ControlChangeHandlerProxy(pedal, self.on_layer_pedal_control_change))
-
-    def __init(self, addr: str = '') -> None:
-        bundle = OscBundleBuilder()
+            maps["/midibox/%s" % (mbp.name)] = (cls.main_control_change, (mbp.name,))
 
-        for mbp in GeneralProps:
-            bundle.add_msg("/midibox/%s" % (mbp.name), getattr(self.mb.general, mbp.name))
+        maps["/midibox/initialize"] = (cls.initialize, ())
+        maps["/midibox/midi"] = (cls.on_midi, ())
+        maps["/midibox/state"] = (cls.on_state, ())
 
-        for lr in self.mb.layers:
-            index = lr._index
+        for lr in cls.mb.layers:
             for mblp in LayerProps:
-                prop = mblp.name
-                bundle.add_msg("/midibox/layers/%d/%s" % (lr._index, prop), getattr(self.mb.layers[index], prop))
-
+                maps["/midibox/layers/%d/%s" % (lr._index, mblp.name)] = (cls.layer_control_change, (lr._index, mblp.name))
             for pedal in lr.pedals:
                 for mbpp in PedalProps:
-                    prop = mbpp.name
-                    bundle.add_msg("/midibox/layers/%d/pedal%d.%s" % (lr._index, pedal._index, prop), getattr(pedal, prop))
-
-        self.send_msg(bundle.build())
+                    maps["/midibox/layers/%d/pedal%d.%s" % (lr._index, pedal._index, mbpp.name)] = (cls.layer_pedal_control_change, (lr._index, pedal._index, mbpp.name))
+
+    def handle_message(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
+        if not self._initialized:
+            self._initialized = True
+            if address != "/init":
+                # Client not sending /init expects the complete state
+                self.queue_changes()
+                self.flush()
+        super().handle_message(address, *values)
+
+    def __init(self, addr: str = '', epoch: Optional[int] = None, revision: Optional[int] = None) -> None:
+        """Send all properties for bare /init; for `/init epoch revision` the state changed
+        after the client revision, or the register image for other epoch (see NO_EPOCH)"""
+        if epoch is None:
+            self.queue_changes()
+        elif epoch == self.mb.epoch and revision is not None:
+            self.queue_changes(revision)
+        else:
+            self.queue_image()
+        self.flush()
+
+    def queue_image(self) -> None:
+        """Complete state as one register image blob, properties not stored in registers are sent separately"""
+        revision = self.mb.revision
+        try:
+            image = self.mb.snapshot()
+        except NotImplementedError:
+            image = {}
+        self.queue_state("/midibox/state", serialize_image(self.mb.encode_image(image)))
+        for proxy, prop in self._fanout.unregistered:
+            self.queue_state(proxy.addresses[prop], getattr(proxy.p, prop))
+        self.queue_state("/midibox/revision", self.mb.epoch, revision)
+
+    def queue_changes(self, since: Optional[int] = None) -> None:
+        # Changes made while collecting have a higher revision and are sent again on the next sync
+        revision = self.mb.revision
+        for proxy in self._fanout.proxies:
+            if since is None:
+                for prop, address in proxy.addresses.items():
+                    self.queue_state(address, getattr(proxy.p, prop))
+            else:
+                for prop, value in proxy.p.changes_since(since).items():
+                    self.queue_state(proxy.addresses.get(prop) or proxy._address % (prop), value)
+        self.queue_state("/midibox/revision", self.mb.epoch, revision)
 
     def finish(self) -> None:
-        self.mb._callbacks.remove(self.mb_midi_callback)
+        self._fanout.remove(self)
         super().finish()
 
-    def mb_midi_callback(self, msg: mido.Message) -> None:
-        if msg.type == 'clock':
-            return
-
-        self.send_message("/midibox/midi", bytes(msg.bytes()))
-
     def on_midi(self, addr: str, param: list[int]) -> None:
         midi = list(param)
         msg = mido.Message.from_bytes(midi)
         self.mb.sendmsg(msg)
 
+    def on_state(self, addr: str, param: bytes) -> None:
+        self.mb.apply_snapshot(parse_image(param), confirm=False)
+
     def initialize(self, addr: str) -> None:
         self.mb.initialize()
 
-    def on_main_control_change(self, **kwargs: Any) -> None:
-        prop, value = list(kwargs.items())[0]
-        self.send_message("/midibox/%s" % (prop), value)
-
-    def on_layer_control_change(self, layer: Layer, **kwargs: Any) -> None:
-        prop, value = list(kwargs.items())[0]
-        self.send_message("/midibox/layers/%d/%s" % (layer._index, prop), value)
-
-    def on_layer_pedal_control_change(self, pedal: Pedal, **kwargs: Any) -> None:
-        prop, value = list(kwargs.items())[0]
-        self.send_message("/midibox/layers/%d/pedal%d.%s" % (pedal._layer._index, pedal._index, prop), value)
-
     def main_control_change(self, addr: str, prop: str, value: Any) -> None:
         if hasattr(self.mb.general, prop):
             setattr(self.mb.general, prop, value)
 
-    def layer_control_change(self, addr: str, layer: Layer, prop: str, value: Any) -> None:
-        if hasattr(layer, prop):
-            setattr(layer, prop, value)
+    def layer_control_change(self, addr: str, layer: int, prop: str, value: Any) -> None:
+        lr = self.mb.layers[layer]
+        if hasattr(lr, prop):
+            setattr(lr, prop, value)
 
-    def layer_pedal_control_change(self, addr: str, pedal: Pedal, prop: str, value: Any) -> None:
-        if hasattr(pedal, prop):
-            setattr(pedal, prop, value)
+    def layer_pedal_control_change(self, addr: str, layer: int, pedal: int, prop: str, value: Any) -> None:
+        p = self.mb.layers[layer].pedals[pedal]
+        if hasattr(p, prop):
+            setattr(p, prop, value)
@@ -1,5 +1,99 @@
-from typing import Union
+import socket
+import struct
+
+from typing import Union, Iterator, Optional, Tuple
 
 
 #OscValue = Union[int, float, bytes, str, bool, Tuple[Any], list[Any]]
 OscValue = Union[int, float, bytes, str, bool] #, Tuple[Any], list[Any]]
+
+_INT = struct.Struct(">i")
+_FLOAT = struct.Struct(">f")
+
+# Upper limit of received OSC packet, larger frame is a protocol error
+MAX_FRAME_SIZE = 1 << 24
+
+# Epoch sent in `/init epoch revision` by a client without any server state yet, never used by a server
+NO_EPOCH = -1
+
+
+class FrameBuffer():
+    """Receive buffer for length-prefixed OSC over TCP
+
+    Data are received into a preallocated buffer and complete frames are
+    returned as memoryview slices, valid until the next recv_into call.
+    """
+
+    def __init__(self, size: int = 4096) -> None:
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._len = 0
+        self._pos = 0
+
+    def _reserve(self, size: int) -> None:
+        """Make room for `size` bytes of unprocessed data"""
+        if size <= len(self._buf):
+            return
+        if size > MAX_FRAME_SIZE + 4:
+            raise ConnectionError("OSC frame too large")
+        # Slices of the old buffer can still be referenced, create a new one
+        rem = self._len - self._pos
+        buf = bytearray(max(size, 2 * len(self._buf)))
+        buf[:rem] = self._view[self._pos:self._len]
+        self._buf, self._view = buf, memoryview(buf)
+        self._len, self._pos = rem, 0
+
+    def recv_into(self, s: socket.socket) -> int:
+        # Move unprocessed data to the beginning
+        if self._pos:
+            rem = self._len - self._pos
+            self._buf[:rem] = self._buf[self._pos:self._len]
+            self._len, self._pos = rem, 0
+
+        if self._len == len(self._buf):
+            self._reserve(len(self._buf) * 2)
+        n = s.recv_into(self._view[self._len:])
+        self._len += n
+        return n
+
+    def frames(self) -> Iterator[memoryview]:
+        while self._len - self._pos >= 4:
+            size = int.from_bytes(self._view[self._pos:self._pos + 4], byteorder='big')
+            end = self._pos + 4 + size
+            if end > self._len:
+                # Make room for the whole frame
+                self._reserve(end - self._pos)
+                break
+            frame = self._view[self._pos + 4:end]
+            self._pos = end
+            yield frame
+
+
+def decode_message(frame: memoryview) -> Optional[Tuple[str, Tuple[OscValue, ...]]]:
+    """Fast path for messages with a single int, float or blob argument
+
+    Returns None for bundles and other messages, use the generic OscPacket parser for them.
+    """
+    head = bytes(frame[:256])
+    end = head.find(b"\0")
+    if end < 1 or head[0] != 0x2F:  # '/'
+        return None
+    pos = (end + 4) & ~3
+    tags = head[pos:pos + 4]
+    pos += 4
+    if tags == b",i\0\0" and len(frame) == pos + 4:
+        return head[:end].decode('ascii'), _INT.unpack_from(frame, pos)
+    elif tags == b",f\0\0" and len(frame) == pos + 4:
+        return head[:end].decode('ascii'), _FLOAT.unpack_from(frame, pos)
+    elif tags == b",b\0\0" and len(frame) >= pos + 4:
+        size = _INT.unpack_from(frame, pos)[0]
+        if size < 0 or len(frame) < pos + 4 + size:
+            return None
+        return head[:end].decode('ascii'), (bytes(frame[pos + 4:pos + 4 + size]),)
+    return None
+
+
+def parse_multicast(value: str, default_port: int) -> Tuple[str, int]:
+    """Multicast address given as `group[:port]`"""
+    group, _, port = value.partition(":")
+    return group, int(port) if port else default_port
@@ -1,63 +1,93 @@
 import time
 import socket
-import socketserver
+import selectors
 import threading
+import traceback
+
+from collections import deque
 
 import netifaces
 
 from zeroconf import ServiceInfo, Zeroconf
 
-from typing import Any, Tuple, Optional
+from typing import Any, Tuple, Optional, Iterable
 
 from pythonosc.osc_message_builder import OscMessageBuilder
 from pythonosc.osc_message import OscMessage
 from pythonosc.osc_bundle import OscBundle
 from pythonosc.osc_packet import OscPacket
+from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
 
-from .osc import OscValue
+from .osc import OscValue, FrameBuffer, decode_message, parse_multicast
 
 DispatchedOscCb = Any
 
 
-class TCPOSCRequestHandler(socketserver.BaseRequestHandler):
+class TCPOSCRequestHandler():
+    """Client connection of TCPOSCServer; all network I/O is done by the server loop"""
     server: "TCPOSCServer"
 
+    def __init__(self, request: socket.socket, client_address: Tuple[str, int], server: "TCPOSCServer") -> None:
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+
+        self._rbuf = FrameBuffer()
+        self._wbuf = bytearray()
+        # Outgoing state updates coalesced by address, last value wins
+        self._outbox: dict[str, Tuple[OscValue, ...]] = {}
+        self._outbox_deadline: Optional[float] = None
+        # Other outgoing frames; bounded, new frames are dropped when full
+        self._outq: deque[bytes] = deque()
+        self._out_lock = threading.Lock()
+        self._write_started: Optional[float] = None  # Last write progress while data are pending
+        self._dropped = 0
+        self._connected = True
+        # Datagram destination of latency sensitive streams, see udp_subscribe
+        self.udp_address: Optional[Tuple[str, int]] = None
+
+        self.setup()
+
     def setup(self) -> None:
-        super().setup()
         print("TCP OSC client connected", self.client_address)
         self.server.clients.append(self)
 
-    def _recv(self, size: int) -> bytes:
-        recv = bytes()
-        while len(recv) != size:
-            if self.request is None:
-                raise ConnectionError
-            b = self.request.recv(size - len(recv))
-            if not b:
-                raise ConnectionError
-
-            recv += b
-        return recv
-
-    def handle(self) -> None:
-        try:
-            while True:
-                data = self._recv(4)
-                size = int.from_bytes(data, byteorder='big')
-                data = self._recv(size)
-                for m in OscPacket(data).messages:
-                    self.handle_message(m.message.address, *m.message.params)
-        except ConnectionError:
-            pass
-
     def finish(self) -> None:
         print("TCP OSC client disconnected", self.client_address)
         self.server.clients.remove(self)
-        super().finish()
+
+    def disconnect(self) -> None:
+        with self._out_lock:
+            self._connected = False
+        self.server.wakeup()
 
     def handle_message(self, address: str, *params: *Tuple[OscValue, ...]) -> None:
         pass
 
+    def handle_frame(self, frame: memoryview) -> None:
+        msg = decode_message(frame)
+        if msg is not None:
+            self.handle_message(msg[0], *msg[1])
+            return
+        for m in OscPacket(bytes(frame)).messages:
+            self.handle_message(m.message.address, *m.message.params)
+
+    def udp_subscribe(self, addr: str, port: int, group: str = '') -> None:
+        """Receive the latency sensitive streams by UDP on `port`, or from the multicast `group`; port 0 unsubscribes"""
+        udp = self.server.udp
+        if udp is None:
+            return
+        if group and udp.multicast_address == (group, port):
+            self.udp_address = udp.multicast_address
+        elif port and not group:
+            self.udp_address = (self.client_address[0], port)
+        else:
+            self.udp_address = None
+
+    def send_stream(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
+        """Send latency sensitive update; by UDP for subscribed clients, otherwise as a state update"""
+        self.server.send_stream(address, values, (self,))
+
     def send_message(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
         builder = OscMessageBuilder(address=address)
         for val in values:
@@ -65,51 +95,340 @@ class TCPOSCRequestHandler(socketserver.BaseRequestHandler):
         msg = builder.build()
         self.send_msg(msg)
 
+    def queue_state(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
+        """Queue state update until the next flush"""
+        with self._out_lock:
+            self._outbox[address] = values
+
+    def send_state(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
+        """Send state update; updates within the coalesce window are sent in one bundle"""
+        with self._out_lock:
+            self._outbox[address] = values
+            if self._outbox_deadline is not None:
+                return
+            self._outbox_deadline = time.monotonic() + self.server.coalesce_window
+        self.server.wakeup()
+
+    def flush(self, delay: float = 0) -> None:
+        with self._out_lock:
+            self._outbox_deadline = time.monotonic() + delay
+        self.server.wakeup()
+
     def send_msg(self, msg: OscMessage | OscBundle) -> None:
-        try:
-            self.request.sendall(msg.size.to_bytes(length=4, byteorder='big') + msg.dgram)
-        except Exception:
-            pass
+        """Queue message for the server loop, never blocks on the network"""
+        frame = msg.size.to_bytes(length=4, byteorder='big') + msg.dgram
+        with self._out_lock:
+            if not self._connected:
+                return
+            if len(self._outq) < self.server.max_queue:
+                self._outq.append(frame)
+                queued = True
+            else:
+                self._dropped += 1
+                queued = False
+
+        if queued:
+            self.server.wakeup()
+        elif self._dropped % 100 == 1:
+            print("TCP OSC client queue full, dropped messages:", self._dropped, self.client_address)
+
+    def _build_state(self, outbox: dict[str, Tuple[OscValue, ...]]) -> bytes:
+        if len(outbox) == 1:
+            address, values = list(outbox.items())[0]
+            builder = OscMessageBuilder(address=address)
+            for val in values:
+                builder.add_arg(val)
+            msg: OscMessage | OscBundle = builder.build()
+        else:
+            bundle = OscBundleBuilder(IMMEDIATELY)
+            for address, values in outbox.items():
+                builder = OscMessageBuilder(address=address)
+                for val in values:
+                    builder.add_arg(val)
+                bundle.add_content(builder.build())  # type: ignore
+            msg = bundle.build()
+        return msg.size.to_bytes(length=4, byteorder='big') + msg.dgram
+
+    def _collect_output(self, now: float) -> None:
+        # Next data are taken after the previous write is done, queued frames wait in the bounded queue
+        if self._wbuf:
+            return
+
+        with self._out_lock:
+            frames = list(self._outq)
+            self._outq.clear()
+            outbox = {}
+            if self._outbox_deadline is not None and self._outbox_deadline <= now:
+                outbox = self._outbox
+                self._outbox = {}
+                self._outbox_deadline = None
+
+        if outbox:
+            frames.append(self._build_state(outbox))
+        if frames:
+            self._wbuf += b"".join(frames)
+            self._write_started = now
+
+    def _next_deadline(self) -> Optional[float]:
+        # While a write is pending the outbox waits for it, the loop waits for EVENT_WRITE or the stall timeout
+        if self._wbuf:
+            return None if self._write_started is None else self._write_started + self.server.stall_timeout
+        with self._out_lock:
+            return self._outbox_deadline
+
+
+DispatcherMaps = dict[str, Tuple[DispatchedOscCb, Tuple[Any, ...]]]
 
 
 class DispatchedOSCRequestHandler(TCPOSCRequestHandler):
+    # Routing tables shared by all connections, built once per handler class
+    _shared_dispatchers: dict[type, DispatcherMaps] = {}
+
+    @classmethod
+    def init_shared_dispatcher(cls, maps: DispatcherMaps) -> None:
+        """Fill the shared routing table; callbacks are called as callback(handler, address, *args, *values)"""
+        maps["/udp/subscribe"] = (cls.udp_subscribe, ())
+
+    @classmethod
+    def shared_dispatcher(cls) -> DispatcherMaps:
+        maps = DispatchedOSCRequestHandler._shared_dispatchers.get(cls)
+        if maps is None:
+            maps = {}
+            cls.init_shared_dispatcher(maps)
+            DispatchedOSCRequestHandler._shared_dispatchers[cls] = maps
+        return maps
+
     # TODO: Fix Any, see callback below
     def map(self, path: str, callback: DispatchedOscCb, *args: *Tuple[Any, ...]) -> None:
         self._dispatcher_maps[path] = (callback, args)
 
     def setup(self) -> None:
         super().setup()
-        self._dispatcher_maps: dict[str, Tuple[DispatchedOscCb, Tuple[Any]]] = {}
+        self._dispatcher_maps: DispatcherMaps = {}
+        self._shared_dispatcher_maps = self.shared_dispatcher()
 
     def handle_message(self, address: str, *values: *Tuple[OscValue, ...]) -> None:
         mapping = self._dispatcher_maps.get(address)
         if mapping:
             callback, args = mapping
             callback(address, *args, *values)
+            return
+
+        mapping = self._shared_dispatcher_maps.get(address)
+        if mapping:
+            callback, args = mapping
+            callback(self, address, *args, *values)
+
+
+class UDPOSCTransport():
+    """Unreliable datagram transport for latency sensitive streams, state changes stay on TCP"""
+
+    def __init__(self, server_address: Tuple[str, int], multicast: Optional[str] = None, multicast_ttl: int = 1) -> None:
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Multicast receivers on this host bind the same port
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        self.multicast_address: Optional[Tuple[str, int]] = None
+        # Multicast is `group[:port]`, port defaults to the UDP port
+        if multicast is not None:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.multicast_address = parse_multicast(multicast, self.server_address[1])
+
+    def sendto(self, msg: OscMessage | OscBundle, address: Tuple[str, int]) -> bool:
+        try:
+            self.socket.sendto(msg.dgram, address)
+        except BlockingIOError:
+            pass  # Dropped, the stream is not reliable
+        except OSError:
+            return False
+        return True
+
+    def close(self) -> None:
+        self.socket.close()
 
 
-class TCPOSCServer(socketserver.ThreadingTCPServer):
-    allow_reuse_address = True
+class TCPOSCServer():
+    """Length-prefixed OSC over TCP; all connections are served by one selector loop thread"""
     clients: list[TCPOSCRequestHandler]
     _server_thread: Optional[threading.Thread]
 
-    def __init__(self, server_address: Tuple[str, int], RequestHandlerClass: type[DispatchedOSCRequestHandler]) -> None:
+    def __init__(self, server_address: Tuple[str, int], RequestHandlerClass: type[DispatchedOSCRequestHandler], coalesce_window: float = 0.005, max_queue: int = 256, stall_timeout: float = 5.0, udp: Optional[UDPOSCTransport] = None) -> None:
         self._server_thread = None
-        super().__init__(server_address, RequestHandlerClass)
-
-    def server_activate(self) -> None:
+        self.udp = udp
+        self.RequestHandlerClass = RequestHandlerClass
+        self.coalesce_window = coalesce_window
+        self.max_queue = max_queue  # Frames waiting for each client
+        self.stall_timeout = stall_timeout  # Disconnect client which doesn't accept data for this time
         self.clients = []
-        super().server_activate()
+        self._shutdown = False
+
+        self.socket = socket.create_server(server_address)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+
+    def wakeup(self) -> None:
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass  # Wakeup already pending
+
+    def send_datagram(self, msg: OscMessage | OscBundle, clients: Iterable[TCPOSCRequestHandler]) -> None:
+        """Send message to clients by UDP where subscribed, once for all multicast clients; others get it by TCP"""
+        multicast = False
+        for c in clients:
+            address = c.udp_address
+            if address is None or self.udp is None:
+                c.send_msg(msg)
+            elif address == self.udp.multicast_address:
+                multicast = True
+            elif not self.udp.sendto(msg, address):
+                c.send_msg(msg)
+        if multicast and self.udp is not None and self.udp.multicast_address is not None:
+            self.udp.sendto(msg, self.udp.multicast_address)
+
+    def send_stream(self, address: str, values: Tuple[OscValue, ...], clients: Iterable[TCPOSCRequestHandler]) -> None:
+        """Send latency sensitive update to the clients, see send_datagram; clients without UDP get a state update"""
+        datagram_clients = []
+        for c in clients:
+            if c.udp_address is None:
+                c.send_state(address, *values)
+            else:
+                datagram_clients.append(c)
+        if datagram_clients:
+            builder = OscMessageBuilder(address=address)
+            for val in values:
+                builder.add_arg(val)
+            self.send_datagram(builder.build(), datagram_clients)
+
+    def serve_forever(self) -> None:
+        while not self._shutdown:
+            now = time.monotonic()
+            deadlines = [d for d in (c._next_deadline() for c in self.clients) if d is not None]
+            timeout = max(min(deadlines) - now, 0) if deadlines else None
+
+            for key, events in self._selector.select(timeout):
+                if key.data is None:
+                    self._accept()
+                elif key.data is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._read(key.data)
+                    if events & selectors.EVENT_WRITE:
+                        self._write(key.data)
+
+            now = time.monotonic()
+            for c in list(self.clients):
+                self._service(c, now)
+
+        for c in list(self.clients):
+            self._close(c)
+        self._selector.close()
+        self.socket.close()
+        if self.udp is not None:
+            self.udp.close()
+
+    def _accept(self) -> None:
+        try:
+            request, client_address = self.socket.accept()
+        except BlockingIOError:
+            return
+        request.setblocking(False)
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            traceback.print_exc()
+            request.close()
+            return
+        self._selector.register(request, selectors.EVENT_READ, handler)
+
+    def _read(self, c: TCPOSCRequestHandler) -> None:
+        try:
+            if c._rbuf.recv_into(c.request) == 0:
+                raise ConnectionError
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(c)
+            return
+
+        try:
+            for frame in c._rbuf.frames():
+                try:
+                    c.handle_frame(frame)
+                except Exception:
+                    traceback.print_exc()
+        except (ConnectionError, ValueError) as e:
+            print("TCP OSC client protocol error, disconnecting:", e, c.client_address)
+            self._close(c)
+
+    def _write(self, c: TCPOSCRequestHandler) -> None:
+        if c.request.fileno() < 0:
+            return
+        try:
+            n = c.request.send(c._wbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            print("TCP OSC client write failed:", e, c.client_address)
+            self._close(c)
+            return
+
+        if n:
+            del c._wbuf[:n]
+            c._write_started = time.monotonic()
+        self._selector.modify(c.request, selectors.EVENT_READ | (selectors.EVENT_WRITE if c._wbuf else 0), c)
+
+    def _service(self, c: TCPOSCRequestHandler, now: float) -> None:
+        if not c._connected:
+            self._close(c)
+            return
+
+        c._collect_output(now)
+        if c._wbuf:
+            if c._write_started is not None and now - c._write_started > self.stall_timeout:
+                print("TCP OSC client stalled, disconnecting", c.client_address)
+                self._close(c)
+                return
+            self._write(c)
+
+    def _close(self, c: TCPOSCRequestHandler) -> None:
+        if c not in self.clients:
+            return
+        with c._out_lock:
+            c._connected = False
+        try:
+            self._selector.unregister(c.request)
+        except (KeyError, ValueError):
+            pass
+        try:
+            c.finish()
+        except Exception:
+            traceback.print_exc()
+        try:
+            c.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        c.request.close()
 
     def shutdown(self) -> None:
-        for c in self.clients:
-            try:
-                c.request.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                pass
-            finally:
-                c.request.close()
-        super().shutdown()
+        self._shutdown = True
+        self.wakeup()
 
     def start(self) -> None:
         if self._server_thread is not None:
@@ -137,19 +456,19 @@ def getIPv4Addresses() -> dict[str, str]:
 
 
 class ZCPublisher(threading.Thread):
-    def __init__(self, port: int = 4302, oscname: str = "MidiboxOSC", allowed_ips: list[str] | None = None) -> list[tuple[Zeroconf, ServiceInfo]]:
+    def __init__(self, port: int = 4302, oscname: str = "MidiboxOSC", allowed_ips: list[str] | None = None, udp_port: Optional[int] = None, multicast_address: Optional[Tuple[str, int]] = None) -> list[tuple[Zeroconf, ServiceInfo]]:
         self._stop_event = threading.Event()
         self._zc_svcs = {}
-        super().__init__(target=self._run, args=(port, oscname, allowed_ips))
+        super().__init__(target=self._run, args=(port, oscname, allowed_ips, udp_port, multicast_address))
         self.start()
 
     def stop(self):
         self._stop_event.set()
         self.join()
 
-    def _run(self, port, oscname, allowed_ips):
+    def _run(self, port, oscname, allowed_ips, udp_port, multicast_address):
         zc_service = "_osc._tcp.local."
-        zc_name = oscname + "." + zc_service
+        zc_udp_service = "_osc._udp.local."
 
         while not self._stop_event.is_set():
             # Workaround to publish all IP addresses
@@ -161,8 +480,19 @@ class ZCPublisher(threading.Thread):
                 zc = Zeroconf([ip])
                 zc.register_service(si)
                 print("Zeroconf register %s on IP %s" % (zc_name, ip))
-                self._zc_svcs.update({ip: (zc, si)})
+                svcs = [si]
+                if udp_port is not None:
+                    # Streams are requested over the TCP service, see /udp/subscribe
+                    props = {"tcp_port": str(port)}
+                    if multicast_address is not None:
+                        props["multicast"] = "%s:%d" % multicast_address
+                    zc_udp_name = f"{oscname}_{ifname}_{udp_port}.{zc_udp_service}"
+                    udp_si = ServiceInfo(zc_udp_service, zc_udp_name, udp_port, addresses=[ip], properties=props) # type: ignore[list-item]
+                    zc.register_service(udp_si)
+                    print("Zeroconf register %s on IP %s" % (zc_udp_name, ip))
+                    svcs.append(udp_si)
+                self._zc_svcs.update({ip: (zc, svcs)})
             time.sleep(1)
 
-        for ip, (zc, si) in self._zc_svcs.items():
+        for ip, (zc, svcs) in self._zc_svcs.items():
             zc.close()
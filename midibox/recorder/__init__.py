@@ -1,4 +1,5 @@
 from .recorder import Recorder
+from .osc_client_handler import RecorderOSCClientHandler
 
 
-__all__ = ["Recorder"]
+__all__ = ["Recorder", "RecorderOSCClientHandler"]
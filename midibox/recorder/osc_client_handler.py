@@ -0,0 +1,28 @@
+from ..osc.server import DispatchedOSCRequestHandler, DispatcherMaps
+from ..midiplayer import Midiplayer
+from .recorder import Recorder
+
+
+class RecorderOSCClientHandler(DispatchedOSCRequestHandler):
+    mr: Recorder
+    mp: Midiplayer
+
+    @classmethod
+    def init_shared_dispatcher(cls, maps: DispatcherMaps) -> None:
+        super().init_shared_dispatcher(maps)
+        # Recorder section
+        maps["/recorder/list"] = (lambda self, addr, *x: self.list(), ())
+        maps["/recorder/load"] = (lambda self, addr, x: self.load(x), ())
+
+    def list(self) -> None:
+        """Send /recorder/session for every recorded session followed by /recorder/list with the count"""
+        sessions = self.mr.sessions()
+        for s in sessions:
+            self.send_message("/recorder/session", s.name, int(s.start), s.duration, s.notes)
+        self.send_message("/recorder/list", len(sessions))
+
+    def load(self, name: str) -> None:
+        path = self.mr.session_path(str(name))
+        if path is None or not path.exists():
+            return
+        self.mp.open(str(path))
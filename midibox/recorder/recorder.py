@@ -1,52 +1,319 @@
+import os
 import time
+import json
+import queue
+import struct
+import threading
 import mido
+from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Any, BinaryIO, Iterator, Sequence, Tuple
 from mido import Message, MidiFile, MidiTrack
 
 
 DEFAULT_TEMPO = 500000
 DEFAULT_TICKS_PER_BEAT = 480
 
+JOURNAL_SUFFIX = ".journal"
+INDEX_NAME = "midibox_rec.index"
+
+# Journal record: timestamp in nanoseconds, length of MIDI data, MIDI data
+# The first record has no MIDI data, its timestamp is the wall clock time of the session start
+_RECORD = struct.Struct("<qB")
+
+# Writer thread commands
+_ROTATE = object()
+_STOP = object()
+
+
+@dataclass
+class Session():
+    name: str  # File name in the recorder directory
+    start: float  # Wall clock time of the session start
+    duration: float  # Seconds from the first to the last event
+    notes: int  # Number of note on events
+    size: int  # Size of the MIDI file
+
+
+class SessionIndex():
+    """Catalog of recorded sessions, stored as JSON lines appended to INDEX_NAME"""
+    def __init__(self, directory: Path) -> None:
+        self._path = directory / INDEX_NAME
+        self._lock = threading.Lock()
+        self._sessions: list[Session] = []
+        try:
+            with open(self._path, 'r') as f:
+                for line in f:
+                    try:
+                        self._sessions.append(Session(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        # Incomplete line after a crash
+                        pass
+        except FileNotFoundError:
+            pass
+
+    def append(self, session: Session) -> None:
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(json.dumps(asdict(session)) + "\n")
+            self._sessions.append(session)
+
+    def sessions(self) -> list[Session]:
+        with self._lock:
+            return list(self._sessions)
+
+    def get(self, name: str) -> Optional[Session]:
+        with self._lock:
+            return next((s for s in self._sessions if s.name == name), None)
+
+
+def read_journal(path: Path) -> Iterator[Tuple[int, bytes]]:
+    """Records of the journal; incomplete record at the end (crash during write) is ignored"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        ts, size = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos + size > len(data):
+            break
+        yield ts, data[pos:pos + size]
+        pos += size
+
+
+def finalize_journal(path: Path, ticks_per_beat: int = DEFAULT_TICKS_PER_BEAT) -> Optional[Session]:
+    """Convert the journal to a Standard MIDI File next to it and remove the journal
+
+    Events are placed at the tick nearest to their time from the first event,
+    so the rounding error does not accumulate over the delta times.
+    Returns None for a journal without events.
+    """
+    track = MidiTrack()
+    mid = MidiFile(ticks_per_beat=ticks_per_beat)
+    mid.tracks.append(track)
+
+    # ticks = ns * ticks_per_beat / (tempo * 1000), rounded to nearest
+    num, den = 2 * ticks_per_beat, 2 * DEFAULT_TEMPO * 1000
+    wallclock: Optional[float] = None
+    start: Optional[int] = None
+    ts = 0
+    last_tick = 0
+    notes = 0
+    for ts, data in read_journal(path):
+        if not data:
+            wallclock = ts / 1_000_000_000
+            continue
+        if start is None:
+            start = ts
+        tick = ((ts - start) * num + den // 2) // den
+        track.append(Message.from_bytes(data, time=tick - last_tick))
+        last_tick = tick
+        if data[0] & 0xF0 == 0x90 and data[2]:
+            notes += 1
+
+    if start is None:
+        path.unlink()
+        return None
+
+    filepath = path.with_suffix("")
+    tmp = filepath.with_name(filepath.name + ".tmp")
+    mid.save(tmp)
+    os.replace(tmp, filepath)
+    path.unlink()
+
+    duration = (ts - start) / 1_000_000_000
+    stat = filepath.stat()
+    if wallclock is None:
+        wallclock = stat.st_mtime - duration
+    return Session(filepath.name, wallclock, duration, notes, stat.st_size)
+
 
 class Recorder():
-    def __init__(self, port: str):
+    """Records the input into an append-only journal, finalized into a MIDI file on close or rotation
+
+    The input callback only queues the events, the journal is written by a background thread.
+    Journals left by a crash are finalized on start.
+
+    Events are stamped in integer nanoseconds: with the rtmidi backend by the delta times
+    measured by the MIDI driver, otherwise by perf_counter_ns on entry to the callback.
+
+    Every session is stored in its own file and listed in the session index. The session ends
+    after `silence_gap` seconds without input, while a note is held after `max_hold` seconds
+    without input (its note off can be lost), or when the journal exceeds `max_size` bytes or
+    `max_duration` seconds; 0 disables the limit.
+    """
+    def __init__(self, port: str, directory: str | Path = "~", max_queue: int = 65536, ticks_per_beat: int = DEFAULT_TICKS_PER_BEAT,
+                 silence_gap: float = 30, max_hold: float = 300, max_size: int = 16 << 20, max_duration: float = 3600):
         self._port_name = port
-        self._midifile = None
+        self._directory = Path(directory).expanduser()
+        self.ticks_per_beat = ticks_per_beat
+        self.silence_gap = silence_gap
+        self.max_hold = max_hold
+        self.max_size = max_size
+        self.max_duration = max_duration
+        # Sum of the rtmidi delta times
+        self._clock_ns = 0
 
-        self.track = MidiTrack()
-        self.mid = MidiFile(ticks_per_beat=DEFAULT_TICKS_PER_BEAT)
-        self.mid.tracks.append(self.track)
+        self.index = SessionIndex(self._directory)
         self.filepath: Optional[Path] = None
-        self.last_save: Optional[float] = None
-        self.last_event = 0.0
+        self._journal: Optional[BinaryIO] = None
+        self._journal_path: Optional[Path] = None
+        # Current session, used by the writer thread only
+        self._session_start = 0
+        self._last_write = 0.0
+        self._held: set[Tuple[int, int]] = set()
+        # Events waiting for the writer; new events are dropped when full
+        self._queue: queue.Queue[Any] = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+        self._writer = threading.Thread(target=self._write_func)
+        self.recover()
         self.init()
 
     def init(self) -> None:
+        self._writer.start()
         self.portin = mido.open_input(self._port_name)
-        self.portin.callback = self._input_callback
+        rt = getattr(self.portin, '_rt', None)
+        if rt is not None:
+            # mido drops the delta time, take the messages directly from rtmidi
+            rt.cancel_callback()
+            rt.set_callback(self._rt_callback)
+        else:
+            self.portin.callback = self._input_callback
+
+    def recover(self) -> list[Path]:
+        ret = []
+        for path in sorted(self._directory.glob(f"midibox_rec_*.mid{JOURNAL_SUFFIX}")):
+            try:
+                session = finalize_journal(path, self.ticks_per_beat)
+            except (OSError, ValueError) as e:
+                print("Recorder: can't recover journal", path, e)
+                continue
+            if session is not None:
+                self.index.append(session)
+                ret.append(self._directory / session.name)
+        return ret
+
+    def sessions(self) -> list[Session]:
+        """Indexed sessions with the file still present"""
+        return [s for s in self.index.sessions() if (self._directory / s.name).exists()]
+
+    def session_path(self, name: str) -> Optional[Path]:
+        return None if self.index.get(name) is None else self._directory / name
+
+    def _put(self, item: Any) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _rt_callback(self, event: Tuple[Sequence[int], float], data: Any = None) -> None:
+        message, delta = event
+        self._clock_ns += round(delta * 1_000_000_000)
+        self._record(self._clock_ns, message)
 
     def _input_callback(self, msg: Message) -> None:
-        ts = time.time()
-        if msg.type in ['note_on', 'note_off', 'control_change']:
-            if self.last_save is None:
-                self.last_event = ts
-                self.last_save = ts
-                self.filepath = Path(f"~/midibox_rec_{int(ts)}.mid").expanduser()
-
-            rts = ts - self.last_event
-            tst = mido.second2tick(rts, DEFAULT_TICKS_PER_BEAT, DEFAULT_TEMPO)
-            m2 = msg.copy(time=tst)
-            self.track.append(m2)
-            self.last_event = ts
-
-        if self.filepath is not None and (
-                msg.type == "reset" or
-                (self.last_save < self.last_event and self.last_save + 60 * 5 < ts)
-        ):
-            self.last_save = self.last_event
-            self.mid.save(self.filepath)
+        ts = time.perf_counter_ns()
+        self._record(ts, msg.bytes())
+
+    def _record(self, ts: int, message: Sequence[int]) -> None:
+        if not message:
+            return
+        status = message[0] & 0xF0 if message[0] < 0xF0 else message[0]
+        if status in (0x80, 0x90, 0xB0):  # note_off, note_on, control_change
+            self._put((ts, bytes(message)))
+        elif status == 0xFF:  # reset
+            self._put(_ROTATE)
+
+    def rotate(self) -> None:
+        """Finalize the current file, next event starts a new one"""
+        self._put(_ROTATE)
+
+    def _write_func(self) -> None:
+        while True:
+            timeout = None
+            gap = self.silence_gap
+            if gap and self._held:
+                # Held notes keep the session open, at most for max_hold
+                gap = max(gap, self.max_hold) if self.max_hold else 0
+            if self._journal is not None and gap:
+                timeout = max(self._last_write + gap - time.monotonic(), 0)
+            try:
+                items = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                self._finalize()
+                continue
+
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is _STOP:
+                    self._finalize()
+                    return
+                elif item is _ROTATE:
+                    self._finalize()
+                else:
+                    self._append(*item)
+
+            if self._journal is not None:
+                self._journal.flush()
+            self._last_write = time.monotonic()
+
+    def _append(self, ts: int, data: bytes) -> None:
+        if self._journal is None:
+            self.filepath, self._journal_path = self._new_filepath(time.time())
+            self._journal = open(self._journal_path, 'ab')
+            self._journal.write(_RECORD.pack(time.time_ns(), 0))
+            self._session_start = ts
+        self._journal.write(_RECORD.pack(ts, len(data)) + data)
+
+        status, channel = data[0] & 0xF0, data[0] & 0x0F
+        if status == 0x90 and data[2]:
+            self._held.add((channel, data[1]))
+        elif status in (0x80, 0x90):
+            self._held.discard((channel, data[1]))
+        elif status == 0xB0 and data[1] in (120, 123):  # all_sound_off, all_notes_off
+            self._held = {held for held in self._held if held[0] != channel}
+
+        if (self.max_size and self._journal.tell() >= self.max_size or
+                self.max_duration and ts - self._session_start >= self.max_duration * 1_000_000_000):
+            self._finalize()
+
+    def _new_filepath(self, ts: float) -> Tuple[Path, Path]:
+        name, n = f"midibox_rec_{int(ts)}", 0
+        while True:
+            filepath = self._directory / f"{name}.mid"
+            journal = filepath.with_name(filepath.name + JOURNAL_SUFFIX)
+            if not filepath.exists() and not journal.exists():
+                return filepath, journal
+            n += 1
+            name = f"midibox_rec_{int(ts)}_{n}"
+
+    def _finalize(self) -> None:
+        if self._journal is None or self._journal_path is None:
+            return
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal.close()
+        self._journal = None
+        self._held.clear()
+        try:
+            session = finalize_journal(self._journal_path, self.ticks_per_beat)
+        except (OSError, ValueError) as e:
+            print("Recorder: can't finalize journal", self._journal_path, e)
+            return
+        if session is not None:
+            self.index.append(session)
 
     def close(self):
-        self.last_save = self.last_event
-        self._input_callback(Message('reset'))
+        rt = getattr(self.portin, '_rt', None)
+        if rt is not None:
+            rt.cancel_callback()
+        else:
+            self.portin.callback = None
+        self._queue.put(_STOP)
+        self._writer.join()
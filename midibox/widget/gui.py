@@ -14,9 +14,9 @@ from PyQt5.QtCore import QTimer
 from PyQt5.QtQuick import QQuickItem
 
 
-from ..controller.base import GeneralProps, LayerProps, PedalProps, BaseMidibox, General, Layer, Pedal
+from ..controller.base import GeneralProps, LayerProps, PedalProps, BaseMidibox, General, Layer, Pedal, PropHandler
 
-from ..config import Preset
+from ..config import FlatPreset, Preset, PresetTransitions
 
 from sip import wrappertype as pyqtWrapperType
 
@@ -154,11 +154,13 @@ class QMidiBox(QObject, metaclass=PropertyMeta):
             lr.bind(control_change=self.on_layer_control_change)
 
         self._presets: dict[int, Preset] = {}
+        self._transitions = PresetTransitions(self.box)
 
     def init(self, ro: QQuickItem, config: dict[str, Any], presets: dict[str, Preset]) -> None:
         presets_btns = ro.findChild(QObject, "presets")
         presets_list = list(presets.values())
         self._presets = {k: v for k, v in enumerate(presets_list)}
+        self._transitions.clear()
         if presets_btns:
             for i, child in enumerate(presets_btns.children()):
                 if len(presets_list) > i:
@@ -187,8 +189,7 @@ class QMidiBox(QObject, metaclass=PropertyMeta):
                 getattr(self, signal_attribute_name(name)).emit(value)
 
     def on_layer_control_change(self, *args: Any, **kwargs: Any) -> None:
-        name = list(kwargs.keys())[0]
-        if name == "transposition_extra":
+        if "transposition_extra" in kwargs:
             self.transpositionExtraChange.emit()
 
     @pyqtSlot(int, str)
@@ -216,41 +217,26 @@ class QMidiBox(QObject, metaclass=PropertyMeta):
     @pyqtSlot(int)
     def loadPreset(self, p: int) -> None:
         if p in self._presets:
-            preset = self._presets[p]
-            config: dict[str, Any] = {}
-            try:
-                preset.get_config(config)
-            except RecursionError:
+            flat = self._presets[p].flat
+            if flat is None:
                 print("Cycle in configuration!!!")
                 return
 
-            with self.box.bundle():
-                for layer_index, layer_config in config.get("layers", {}).items():
-                    layer = self._layers[layer_index]
-                    for k, v in layer_config.items():
-                        if k == 'pedals':
-                            for pi, pedal_config in v.items():
-                                pedal = layer.pedals[pi]
-                                for pk, pv in pedal_config.items():
-                                    if hasattr(pedal, pk):
-                                        if pk == "mode":
-                                            pv = {
-                                                'none': 0,
-                                                'normal': 1,
-                                                'note_length': 2,
-                                                'toggle_active': 3,
-                                                'push_active': 4,
-                                            }[pv]
-                                        setattr(pedal, pk, pv)
-                        else:
-                            if hasattr(layer, k):
-                                setattr(layer, k, v)
-
-                for k, v in config.get("global", {}).items():
-                    if k not in ['enabled', 'transpositionExtra']:
-                        continue
-                    if hasattr(self, k):
-                        setattr(self, k, v)
+            self._transitions.switch(flat, self._apply_preset)
+
+    def _apply_preset(self, flat: FlatPreset) -> None:
+        with self.box.bundle():
+            for layer_index, pedal_index, k, v in flat.props:
+                layer = self.box.layers[layer_index]
+                target: PropHandler = layer if pedal_index is None else layer.pedals[pedal_index]
+                if hasattr(target, k):
+                    setattr(target, k, v)
+
+            for k, v in flat.globals:
+                if k not in ['enabled', 'transpositionExtra']:
+                    continue
+                if hasattr(self, k):
+                    setattr(self, k, v)
 
 
 class GraphUpdater(QObject):